@@ -0,0 +1,123 @@
+"""Compare the memory used by the vault index against a dict of `Path`s.
+
+Indexes synthetic vaults of increasing size, shaped like a notes vault:
+folders of a few dozen notes and attachments, nested a few levels deep.
+Pass the path of a real vault to measure that as well.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from obsidian_to_typst import obsidian_path
+from obsidian_to_typst.vault_index import VaultIndex, Walk
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+VAULT_SIZES = [1_000, 10_000, 100_000, 250_000]
+FILES_PER_FOLDER = 40
+FOLDERS_PER_FOLDER = 8
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> int:
+    logger.info(
+        "%10s %14s %14s %12s %12s",
+        "files",
+        "dict bytes",
+        "index bytes",
+        "bytes/file",
+        "build secs",
+    )
+    for file_count in VAULT_SIZES:
+        root = Path("/vault")
+        walk = list(synthetic_walk(root, file_count))
+        report(file_count, *measure(root, walk))
+
+    for vault in sys.argv[1:]:
+        root = Path(vault).resolve()
+        walk = list(disk_walk(root))
+        file_count = sum(len(files) for _, _, files in walk)
+        report(file_count, *measure(root, walk))
+    return 0
+
+
+def synthetic_walk(root: Path, file_count: int) -> Walk:
+    folders = [root]
+    remaining = file_count
+    while remaining > 0:
+        folder = folders.pop(0)
+        files = [
+            f"Note {remaining - i:06d}.md"
+            if i % 4
+            else f"Pasted image {remaining - i:06d}.png"
+            for i in range(min(FILES_PER_FOLDER, remaining))
+        ]
+        remaining -= len(files)
+        subfolders = [
+            f"Folder {len(folders) + i}" for i in range(FOLDERS_PER_FOLDER)
+        ]
+        folders.extend(folder / name for name in subfolders)
+        yield str(folder), subfolders, files
+
+
+def disk_walk(root: Path) -> Walk:
+    for dir_path, dirs, files in os.walk(root):
+        if obsidian_path.CACHE_FOLDER_NAME in dirs:
+            dirs.remove(obsidian_path.CACHE_FOLDER_NAME)
+        yield dir_path, dirs, files
+
+
+def measure(root: Path, walk: list) -> tuple[int, int, float]:
+    def naive() -> dict[str, Path]:
+        found = {}
+        for dir_path, _dirs, files in walk:
+            for name in files:
+                found.setdefault(name, Path(dir_path) / name)
+        return found
+
+    def build() -> VaultIndex:
+        return VaultIndex.from_walk(root, walk)
+
+    dict_bytes = traced(naive)
+    index_bytes = traced(build)
+    # Time the build separately, since tracing slows allocation down.
+    start = time.perf_counter()
+    build()
+    return dict_bytes, index_bytes, time.perf_counter() - start
+
+
+def traced(build: Callable[[], object]) -> int:
+    """Bytes still allocated by `build` once it returns."""
+    tracemalloc.start()
+    result = build()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def report(
+    file_count: int, dict_bytes: int, index_bytes: int, seconds: float
+) -> None:
+    logger.info(
+        "%10s %14s %14s %12.1f %12.3f",
+        file_count,
+        dict_bytes,
+        index_bytes,
+        index_bytes / file_count,
+        seconds,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    raise SystemExit(main())
@@ -0,0 +1,439 @@
+"""Check that the converter in the working tree matches a reference revision.
+
+Runs the `process_markdown` engine from a git revision (`HEAD` by default)
+and the engine in the working tree over several classes of input:
+
+- examples: the notes in `examples/`,
+- synthetic: a generated vault of notes that link to and embed each other,
+- large: a few long generated documents,
+- random: randomly generated markdown, rendered in the synthetic vault.
+
+The typst each engine produces must match byte for byte, and both engines
+must fail with the same exception on the same input. Mismatching inputs
+are shrunk to a minimal set of lines before they are reported. The time
+each engine spends converting each class of input is reported, so the
+same run shows whether an optimization pays off.
+
+Each engine runs in its own worker process, so that both can be imported
+under the same package name and keep their module level state apart.
+
+    uv run python scripts/differential_check.py --reference HEAD~3
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Self
+
+if TYPE_CHECKING:
+    import types
+    from collections.abc import Callable, Iterator
+
+PROJECT_ROOT_DIR = Path(__file__).resolve().parent.parent
+EXAMPLES_DIR = PROJECT_ROOT_DIR / "examples"
+RAISED = "raised "
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--reference", default="HEAD", help="git revision to compare against"
+    )
+    parser.add_argument(
+        "--random-cases", type=int, default=300, help="random inputs to try"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="convert each input this many times, and time the fastest",
+    )
+    parser.add_argument("--worker", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return worker(args.worker)
+
+    with tempfile.TemporaryDirectory(prefix="differential-") as scratch_dir:
+        scratch = Path(scratch_dir)
+        reference_src = export_revision(args.reference, scratch / "reference")
+        vault = scratch / "vault"
+        make_synthetic_vault(vault, random.Random(args.seed))  # noqa: S311
+        with (
+            Engine(reference_src, scratch / "temp") as reference,
+            Engine(PROJECT_ROOT_DIR / "src", scratch / "temp") as candidate,
+        ):
+            mismatches = 0
+            report = []
+            for name, cases in input_classes(vault, args):
+                result = compare(name, cases, reference, candidate, args.repeat)
+                mismatches += result.mismatches
+                report.append(result)
+
+    logger.info("")
+    logger.info(
+        "%-10s %7s %10s %12s %12s %8s",
+        "inputs",
+        "cases",
+        "mismatches",
+        "reference s",
+        "candidate s",
+        "speedup",
+    )
+    for result in report:
+        logger.info(
+            "%-10s %7s %10s %12.3f %12.3f %7.2fx",
+            result.name,
+            result.cases,
+            result.mismatches,
+            result.reference_seconds,
+            result.candidate_seconds,
+            result.reference_seconds / max(result.candidate_seconds, 1e-9),
+        )
+    return 1 if mismatches else 0
+
+
+class Case:
+    def __init__(self, vault: Path, file: Path, text: str) -> None:
+        self.vault = vault
+        self.file = file
+        self.text = text
+
+
+class ClassResult:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.cases = 0
+        self.mismatches = 0
+        self.raised = 0
+        self.reference_seconds = 0.0
+        self.candidate_seconds = 0.0
+
+
+def input_classes(
+    vault: Path, args: argparse.Namespace
+) -> Iterator[tuple[str, list[Case]]]:
+    yield (
+        "examples",
+        [
+            Case(note.parent, note, note.read_text(encoding="UTF-8"))
+            for note in sorted(EXAMPLES_DIR.glob("*/*.md"))
+        ],
+    )
+    yield (
+        "synthetic",
+        [
+            Case(vault, note, note.read_text(encoding="UTF-8"))
+            for note in sorted(vault.glob("*/Note *.md"))
+        ],
+    )
+    rng = random.Random(args.seed)  # noqa: S311
+    yield (
+        "large",
+        [
+            Case(vault, vault / f"Large {i}.md", random_markdown(rng, 5000))
+            for i in range(3)
+        ],
+    )
+    yield (
+        "random",
+        [
+            Case(vault, vault / "Random.md", random_markdown(rng, 40))
+            for _ in range(args.random_cases)
+        ],
+    )
+
+
+def compare(
+    name: str,
+    cases: list[Case],
+    reference: Engine,
+    candidate: Engine,
+    repeat: int,
+) -> ClassResult:
+    result = ClassResult(name)
+    for case in cases:
+        expected, reference_seconds = reference.convert(case, repeat)
+        actual, candidate_seconds = candidate.convert(case, repeat)
+        result.cases += 1
+        result.reference_seconds += reference_seconds
+        result.candidate_seconds += candidate_seconds
+        result.raised += expected.startswith(RAISED)
+        if expected == actual:
+            continue
+
+        result.mismatches += 1
+
+        def differs(lines: list[str], case: Case = case) -> bool:
+            shrunk = Case(case.vault, case.file, "".join(lines))
+            return (
+                reference.convert(shrunk, 1)[0]
+                != candidate.convert(shrunk, 1)[0]
+            )
+
+        lines = ddmin(case.text.splitlines(keepends=True), differs)
+        shrunk = Case(case.vault, case.file, "".join(lines))
+        logger.error(
+            "%s: `%s` converts differently. Minimal input:\n%s\n"
+            "reference:\n%s\ncandidate:\n%s",
+            name,
+            case.file.name,
+            shrunk.text,
+            reference.convert(shrunk, 1)[0],
+            candidate.convert(shrunk, 1)[0],
+        )
+    logger.info(
+        "%s: %s cases, %s raised, %s mismatches",
+        name,
+        result.cases,
+        result.raised,
+        result.mismatches,
+    )
+    return result
+
+
+def ddmin(items: list[str], fails: Callable[[list[str]], bool]) -> list[str]:
+    """Shrink `items` to a smaller list that still `fails`.
+
+    Zeller's delta debugging: try ever smaller chunks of the input, and
+    their complements, keeping any that still fail.
+    """
+    granularity = 2
+    while len(items) >= 2:  # noqa: PLR2004
+        chunk = math.ceil(len(items) / granularity)
+        subsets = [items[i : i + chunk] for i in range(0, len(items), chunk)]
+        for i, subset in enumerate(subsets):
+            complement = [
+                item for j, s in enumerate(subsets) if j != i for item in s
+            ]
+            if fails(subset):
+                items, granularity = subset, 2
+                break
+            if fails(complement):
+                items, granularity = complement, max(granularity - 1, 2)
+                break
+        else:
+            if granularity >= len(items):
+                break
+            granularity = min(granularity * 2, len(items))
+    return items
+
+
+class Engine:
+    """A worker process converting with the engine in `src`."""
+
+    def __init__(self, src: Path, temp_dir: Path) -> None:
+        self.src = src
+        self.temp_dir = temp_dir
+        self.process: subprocess.Popen | None = None
+
+    def __enter__(self) -> Self:
+        self.process = subprocess.Popen(  # noqa: S603
+            [sys.executable, __file__, "--worker", str(self.src)],
+            # `cleanup` lists labels in set order, which depends on the
+            # hash seed, so both engines must share one.
+            env={**os.environ, "PYTHONHASHSEED": "0"},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding="UTF-8",
+        )
+        return self
+
+    def __exit__(self, *_args: object) -> None:
+        self.process.stdin.close()
+        self.process.wait()
+
+    def convert(self, case: Case, repeat: int) -> tuple[str, float]:
+        """The typst for `case`, or the exception it raised, and the time."""
+        job = {
+            "vault": str(case.vault),
+            "file": str(case.file),
+            "text": case.text,
+            "temp": str(self.temp_dir),
+            "repeat": repeat,
+        }
+        self.process.stdin.write(json.dumps(job) + "\n")
+        self.process.stdin.flush()
+        result = json.loads(self.process.stdout.readline())
+        return result["output"], result["seconds"]
+
+
+def worker(src: Path) -> int:
+    sys.path.insert(0, str(src))
+    from obsidian_to_typst import (  # noqa: PLC0415
+        obsidian_path,
+        process_markdown,
+    )
+
+    try:
+        from obsidian_to_typst import cache_store  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        cache_store.READ_ONLY = True
+    logging.disable(logging.CRITICAL)
+
+    # Keep anything the engine prints out of the replies.
+    replies = sys.stdout
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        job = json.loads(line)
+        temp_dir = Path(job["temp"])
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        obsidian_path.VAULT_ROOT = Path(job["vault"])
+        obsidian_path.TEMP_FOLDER = temp_dir
+        best = math.inf
+        for _ in range(job["repeat"]):
+            reset_state(process_markdown, obsidian_path)
+            process_markdown.init_state(temp_dir, Path(job["file"]))
+            start = time.perf_counter()
+            try:
+                output = process_markdown.obsidian_to_typst(job["text"])
+            except Exception as e:  # noqa: BLE001
+                # Messages may be reworded, but the failure must not change.
+                output = f"{RAISED}{type(e).__name__}"
+            best = min(best, time.perf_counter() - start)
+        replies.write(json.dumps({"output": output, "seconds": best}) + "\n")
+        replies.flush()
+    return 0
+
+
+def reset_state(
+    process_markdown: types.ModuleType, obsidian_path: types.ModuleType
+) -> None:
+    """Forget what the last conversion left in the engine's module globals.
+
+    Older revisions keep more of it outside `init_state`, such as the
+    references seen so far. Caches of the vault stay warm, so that repeats
+    time the conversion itself.
+    """
+    process_markdown.referenced_docs.clear()
+    process_markdown.docs_embedded.clear()
+    if hasattr(process_markdown, "Options"):
+        process_markdown.OPTIONS = process_markdown.Options()
+    if hasattr(obsidian_path, "forget_missing"):
+        obsidian_path.forget_missing()
+
+
+def export_revision(revision: str, dest: Path) -> Path:
+    """Extract `src/` at `revision`, returning the extracted `src/`."""
+    archive = subprocess.run(  # noqa: S603
+        ["git", "archive", "--format=tar", revision, "src"],  # noqa: S607
+        cwd=PROJECT_ROOT_DIR,
+        check=True,
+        capture_output=True,
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(dest, filter="data")
+    return dest / "src"
+
+
+def make_synthetic_vault(vault: Path, rng: random.Random) -> None:
+    """A vault of notes that embed and link to each other, without cycles."""
+    (vault / ".obsidian").mkdir(parents=True)
+    (vault / "assets").mkdir()
+    for asset in ["hello_widget.png", "widget_datasheet.pdf"]:
+        shutil.copy(EXAMPLES_DIR / "feature_guide" / asset, vault / "assets")
+    note_count = 30
+    for i in range(note_count):
+        lines = [f"# Note {i}\n", "\n"]
+        for section in range(rng.randint(1, 4)):
+            lines += [f"## Section {i}.{section}\n", "\n"]
+            lines += random_lines(rng, rng.randint(2, 12))
+            if i + 1 < note_count and rng.random() < 0.3:  # noqa: PLR2004
+                lines += [
+                    "\n",
+                    f"![[Note {rng.randint(i + 1, note_count - 1)}]]\n",
+                ]
+            lines.append("\n")
+        folder = vault / f"folder {i % 4}"
+        folder.mkdir(exist_ok=True)
+        (folder / f"Note {i}.md").write_text("".join(lines), encoding="UTF-8")
+
+
+def random_markdown(rng: random.Random, line_count: int) -> str:
+    # Notes of the synthetic vault only embed later notes, so documents
+    # outside of it may embed any of them without forming a cycle.
+    kinds = [*LINE_KINDS, lambda rng: [f"![[Note {rng.randint(0, 29)}]]\n"]]
+    return "".join(random_lines(rng, line_count, kinds))
+
+
+def random_lines(
+    rng: random.Random,
+    line_count: int,
+    kinds: list[Callable[[random.Random], list[str]]] | None = None,
+) -> list[str]:
+    kinds = kinds or LINE_KINDS
+    lines = []
+    while len(lines) < line_count:
+        lines += rng.choice(kinds)(rng)
+    return lines
+
+
+def random_text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS)(rng) for _ in range(rng.randint(1, 12)))
+
+
+def random_heading(rng: random.Random) -> str:
+    level = "#" * rng.randint(1, 5)
+    return f"{level} {rng.choice(['Intro', 'Section', 'Heading'])}\n"
+
+
+def random_list_item(rng: random.Random) -> str:
+    indent = "    " * rng.randint(0, 2)
+    return f"{indent}{rng.choice(['-', '1.', '2.'])} {random_text(rng)}\n"
+
+
+WORDS: list[Callable[[random.Random], str]] = [
+    lambda rng: rng.choice(["widget", "sprocket", "the", "a", "of", "Übung"]),
+    lambda rng: rng.choice(["and", "with", "42", "3.14", "x_1", "a\\*b"]),
+    lambda rng: f"**{rng.choice(['bold', 'strong text'])}**",
+    lambda rng: f"*{rng.choice(['italic', 'slanted'])}*",
+    lambda rng: f"`{rng.choice(['code', 'x = 1', '#not_typst'])}`",
+    lambda rng: f"[[Note {rng.randint(0, 29)}]]",
+    lambda rng: f"[[Note {rng.randint(0, 29)}#Section {rng.randint(0, 29)}.0]]",
+    lambda rng: f"[[#{rng.choice(['Intro', 'Section', 'Heading'])}]]",
+    lambda _rng: "[site](https://example.com/a_b)",
+    lambda rng: rng.choice(["$x^2$", "#hash", "@at", "<tag>", "\\#", "~"]),
+]
+
+
+LINE_KINDS: list[Callable[[random.Random], list[str]]] = [
+    lambda rng: [random_text(rng) + "\n"],
+    lambda rng: [random_text(rng) + "\n"],
+    lambda _rng: ["\n"],
+    lambda rng: [random_heading(rng)],
+    lambda rng: [random_list_item(rng)],
+    lambda rng: [f"> {random_text(rng)}\n"],
+    lambda rng: [
+        f"```{rng.choice(['', 'python', 'c', 'typst', 'mermaid'])}\n",
+        *(f"{random_text(rng)}\n" for _ in range(rng.randint(0, 4))),
+        "```\n",
+    ],
+    lambda _rng: ["$$\n", "x = y^2\n", "$$\n"],
+    lambda _rng: ["![[hello_widget.png|100]]\n"],
+    lambda _rng: ["![[hello_widget.png]]\n"],
+    lambda _rng: ["![[widget_datasheet.pdf]]\n"],
+    lambda _rng: ["---\n"],
+]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    raise SystemExit(main())
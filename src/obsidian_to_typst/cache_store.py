@@ -0,0 +1,239 @@
+"""Cache of expensive lookups, shared by every run against a vault.
+
+Entries live in an SQLite database in the vault's cache folder, so they
+survive between runs and are shared safely by concurrent conversions. Keys
+are grouped by namespace. An entry may carry a validator, such as a hash of
+the file it was computed from, and is ignored once the validator changes.
+The least recently used entries are evicted once the cache outgrows
+`MAX_BYTES`.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+from pydantic.dataclasses import dataclass
+
+from obsidian_to_typst import metrics, obsidian_path
+
+_logger = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = "cache.sqlite3"
+SCHEMA_VERSION = 1
+MAX_BYTES = int(os.environ.get("OBSIDIAN_TO_TYPST_CACHE_SIZE", str(64 * 2**20)))
+BUSY_TIMEOUT = 10.0
+# Only record reads of an entry this long after the last one, so that hot
+# entries do not turn every read into a write.
+ACCESS_RESOLUTION = 60.0
+# Leave some room after evicting, so that eviction does not run on every
+# write once the cache is full.
+EVICT_TO = 0.9
+
+# Writing nothing to disk, when converting to stdout, includes the cache.
+READ_ONLY = False
+
+_LOCAL = threading.local()
+
+
+@dataclass
+class NamespaceStats:
+    namespace: str
+    entries: int
+    size: int
+
+
+def cache_path(vault_root: Path) -> Path:
+    return vault_root / obsidian_path.CACHE_FOLDER_NAME / CACHE_FILE_NAME
+
+
+def content_hash(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def get(
+    vault_root: Path, namespace: str, key: str, validator: str = ""
+) -> Any | None:  # noqa: ANN401
+    """The value cached under `key`, if it was cached with `validator`."""
+    now = time.time()
+    counter = "cache_" + namespace.replace("-", "_")
+    try:
+        connection = _connection(vault_root, create=False)
+        if connection is None:
+            metrics.hit(counter, found=False)
+            return None
+        row = connection.execute(
+            "SELECT value, accessed FROM entries"
+            " WHERE namespace = ? AND key = ? AND validator = ?",
+            (namespace, key, validator),
+        ).fetchone()
+        metrics.hit(counter, found=row is not None)
+        if row is None:
+            return None
+        value, accessed = row
+        if not READ_ONLY and now - accessed > ACCESS_RESOLUTION:
+            connection.execute(
+                "UPDATE entries SET accessed = ?"
+                " WHERE namespace = ? AND key = ?",
+                (now, namespace, key),
+            )
+    except sqlite3.Error as e:
+        _logger.debug("Cache read failed: %s", e)
+        return None
+    return json.loads(value)
+
+
+def put(
+    vault_root: Path,
+    namespace: str,
+    key: str,
+    value: Any,  # noqa: ANN401
+    validator: str = "",
+) -> None:
+    """Cache `value`, which must be JSON serializable, under `key`."""
+    if READ_ONLY:
+        return
+    text = json.dumps(value)
+    size = len(namespace) + len(key) + len(validator) + len(text)
+    try:
+        connection = _connection(vault_root, create=True)
+        with _transaction(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (namespace, key, validator, value, size, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, validator, text, size, time.time()),
+            )
+            _evict(connection)
+    except (sqlite3.Error, OSError) as e:
+        # The cache is only an optimization, so a busy or read only vault
+        # must not fail the conversion.
+        _logger.debug("Cache write failed: %s", e)
+
+
+def stats(vault_root: Path) -> list[NamespaceStats]:
+    connection = _connection(vault_root, create=False)
+    if connection is None:
+        return []
+    rows = connection.execute(
+        "SELECT namespace, COUNT(*), SUM(size) FROM entries"
+        " GROUP BY namespace ORDER BY namespace"
+    ).fetchall()
+    return [
+        NamespaceStats(namespace=namespace, entries=entries, size=size)
+        for namespace, entries, size in rows
+    ]
+
+
+def clear(vault_root: Path, namespace: str | None = None) -> int:
+    """Remove the entries in `namespace`, or every entry.
+
+    Returns the number of entries removed.
+    """
+    connection = _connection(vault_root, create=False)
+    if connection is None:
+        return 0
+    with _transaction(connection):
+        if namespace is None:
+            cursor = connection.execute("DELETE FROM entries")
+        else:
+            cursor = connection.execute(
+                "DELETE FROM entries WHERE namespace = ?", (namespace,)
+            )
+    return cursor.rowcount
+
+
+def close() -> None:
+    """Close this thread's connections."""
+    connections = getattr(_LOCAL, "connections", {})
+    for connection in connections.values():
+        connection.close()
+    connections.clear()
+
+
+def _evict(connection: sqlite3.Connection) -> None:
+    (total,) = connection.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM entries"
+    ).fetchone()
+    if total <= MAX_BYTES:
+        return
+    rows = connection.execute(
+        "SELECT namespace, key, size FROM entries ORDER BY accessed"
+    )
+    evicted = []
+    for namespace, key, size in rows:
+        if total <= MAX_BYTES * EVICT_TO:
+            break
+        evicted.append((namespace, key))
+        total -= size
+    connection.executemany(
+        "DELETE FROM entries WHERE namespace = ? AND key = ?", evicted
+    )
+    _logger.debug("Evicted %s cache entries", len(evicted))
+
+
+@contextlib.contextmanager
+def _transaction(connection: sqlite3.Connection) -> Iterator[None]:
+    # Take the write lock up front. Upgrading a read to a write part way
+    # through fails immediately, rather than waiting, when another process
+    # is writing.
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def _connection(vault_root: Path, create: bool) -> sqlite3.Connection | None:
+    # SQLite connections must not be shared between threads, nor survive
+    # into a forked process, so each thread of each process opens its own.
+    connections = getattr(_LOCAL, "connections", None)
+    if connections is None:
+        connections = _LOCAL.connections = {}
+    key = (os.getpid(), cache_path(vault_root))
+    connection = connections.get(key)
+    if connection is not None:
+        return connection
+
+    path = cache_path(vault_root)
+    if not path.exists():
+        if not create:
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(
+        path, timeout=BUSY_TIMEOUT, isolation_level=None
+    )
+    connection.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    with _transaction(connection):
+        (version,) = connection.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            connection.execute("DROP TABLE IF EXISTS entries")
+            connection.execute(
+                "CREATE TABLE entries ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " validator TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " accessed REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key)"
+                ") WITHOUT ROWID"
+            )
+            connection.execute(
+                "CREATE INDEX entries_accessed ON entries (accessed)"
+            )
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    connections[key] = connection
+    return connection
@@ -0,0 +1,182 @@
+"""Resident conversion daemon and the thin client used to reach it.
+
+Requests and responses are single JSON documents, one per connection, each
+terminated by a newline. The transport knows nothing about conversion; the
+CLI supplies the handler that turns a request into a response.
+"""
+
+import ipaddress
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import tempfile
+from collections.abc import Callable
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], dict]
+
+TCP_ADDRESS_REGEX = r"^([\w.-]+):(\d+)$"
+CONNECT_TIMEOUT = 1.0
+
+
+def default_address() -> str:
+    env_address = os.environ.get("OBSIDIAN_TO_TYPST_DAEMON")
+    if env_address:
+        return env_address
+    if not hasattr(socket, "AF_UNIX"):  # pragma: no cover
+        return "127.0.0.1:43117"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return str(Path(runtime_dir) / "obsidian-to-typst.sock")
+    # Every user shares the temporary directory, so keep the socket in a
+    # directory of this user's own.
+    private_dir = f"obsidian-to-typst-{os.getuid()}"
+    return str(Path(tempfile.gettempdir()) / private_dir / "daemon.sock")
+
+
+def parse_address(address: str) -> str | tuple[str, int]:
+    """
+    >>> parse_address("localhost:8123")
+    ('localhost', 8123)
+
+    >>> parse_address("/run/user/1000/obsidian-to-typst.sock")
+    '/run/user/1000/obsidian-to-typst.sock'
+    """
+    m = re.match(TCP_ADDRESS_REGEX, address)
+    if m:
+        return m.group(1), int(m.group(2))
+    return address
+
+
+def is_own_socket(socket_path: Path) -> bool:
+    """Whether `socket_path` belongs to this user.
+
+    Another user's socket may be a daemon listening in this user's place,
+    so documents are never sent to one.
+    """
+    try:
+        owner = socket_path.stat().st_uid
+    except OSError:
+        return False
+    if owner == os.getuid():
+        return True
+    _logger.warning("Ignoring `%s`, which belongs to another user", socket_path)
+    return False
+
+
+class DaemonError(Exception):
+    pass
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.handler(request)
+        except Exception as e:
+            _logger.exception("Failed to handle daemon request")
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response).encode("UTF-8") + b"\n")
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socket, "AF_UNIX"):
+
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def make_server(address: str, handler: Handler) -> socketserver.BaseServer:
+    """Listen on `address`, a Unix socket path or a loopback `HOST:PORT`.
+
+    The daemon reads and writes files on behalf of whoever connects, so it
+    only accepts connections from this user, or from this machine over TCP.
+    """
+    parsed = parse_address(address)
+    if isinstance(parsed, tuple):
+        if not is_loopback(parsed[0]):
+            msg = (
+                f"Refusing to listen on `{address}`, which other machines can"
+                " reach.  Use a loopback address, such as 127.0.0.1"
+            )
+            raise DaemonError(msg)
+        server = _TCPServer(parsed, _RequestHandler)
+    else:
+        socket_path = Path(parsed)
+        socket_path.parent.mkdir(mode=0o700, exist_ok=True)
+        if socket_path.exists():
+            if request(address, {"command": "ping"}) is not None:
+                msg = f"A daemon is already listening on `{address}`"
+                raise DaemonError(msg)
+            socket_path.unlink()
+        server = _UnixServer(parsed, _RequestHandler)
+        socket_path.chmod(0o600)
+    server.handler = handler
+    return server
+
+
+def is_loopback(host: str) -> bool:
+    """Whether every address `host` resolves to is on this machine.
+
+    >>> is_loopback("127.0.0.1"), is_loopback("0.0.0.0")
+    (True, False)
+    """
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except OSError:
+        return False
+    return all(
+        ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback
+        for info in infos
+    )
+
+
+def serve(address: str, handler: Handler) -> None:  # pragma: no cover
+    server = make_server(address, handler)
+    _logger.info("Listening on `%s`", address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        _logger.info("Shutting down")
+    finally:
+        server.server_close()
+        if not isinstance(parse_address(address), tuple):
+            Path(address).unlink(missing_ok=True)
+
+
+def request(address: str, payload: dict) -> dict | None:
+    """Send `payload` to the daemon, or return None if none is listening."""
+    parsed = parse_address(address)
+    try:
+        if isinstance(parsed, tuple):
+            sock = socket.create_connection(parsed, timeout=CONNECT_TIMEOUT)
+        else:
+            if not hasattr(socket, "AF_UNIX"):  # pragma: no cover
+                return None
+            if not is_own_socket(Path(parsed)):
+                return None
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(parsed)
+    except OSError:
+        return None
+
+    with sock:
+        # Conversions can take far longer than connecting does.
+        sock.settimeout(None)
+        sock.sendall(json.dumps(payload).encode("UTF-8") + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        msg = f"Daemon at `{address}` closed the connection without replying"
+        raise DaemonError(msg)
+    return json.loads(line)
@@ -0,0 +1,179 @@
+"""Index of the notes and assets each exported document depends on.
+
+Each conversion records the embedded notes, images, PDFs and linked notes
+it used. Inverting that index tells which documents have to be rebuilt
+when files change.
+"""
+
+import contextlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from obsidian_to_typst import obsidian_path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows
+    fcntl = None
+    import msvcrt
+
+INDEX_FILE_NAME = "dependencies.json"
+LOCK_FILE_NAME = "dependencies.lock"
+INDEX_VERSION = 1
+NAME_STATUS_REGEX = r"^[ACDMRTUXB]\d*\t"
+
+_LOCK = threading.Lock()
+
+
+def index_path(vault_root: Path) -> Path:
+    return vault_root / obsidian_path.CACHE_FOLDER_NAME / INDEX_FILE_NAME
+
+
+def vault_key(vault_root: Path, path: Path) -> str:
+    rel_path = os.path.relpath(path.resolve(), vault_root.resolve())
+    return "/" + obsidian_path.format_path(Path(rel_path))
+
+
+def load(vault_root: Path) -> dict[str, list[str]]:
+    try:
+        with index_path(vault_root).open(encoding="UTF-8") as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if index.get("version") != INDEX_VERSION:
+        return {}
+    return index["documents"]
+
+
+def record(
+    vault_root: Path, document: Path, dependencies: Iterable[Path]
+) -> None:
+    """Replace the recorded dependencies of `document`."""
+    with _locked(vault_root):
+        documents = load(vault_root)
+        documents[vault_key(vault_root, document)] = sorted(
+            {vault_key(vault_root, d) for d in dependencies}
+        )
+
+        # Write a new file and rename it into place, so that readers, which
+        # don't take the lock, never see a half written index.
+        path = index_path(vault_root)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix=".json")
+        with os.fdopen(fd, "w", encoding="UTF-8") as f:
+            json.dump(
+                {"version": INDEX_VERSION, "documents": documents}, f, indent=1
+            )
+        Path(temp_name).replace(path)
+
+
+@contextlib.contextmanager
+def _locked(vault_root: Path) -> Iterator[None]:
+    """Hold the index for a read, modify and write.
+
+    Concurrent runs, including other processes, would otherwise each write
+    back the index they read, losing each other's documents.
+    """
+    path = index_path(vault_root).with_name(LOCK_FILE_NAME)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _LOCK, path.open("a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:  # pragma: no cover
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        # Closing the file releases the lock.
+        yield
+
+
+def affected_documents(vault_root: Path, changed: Iterable[Path]) -> list[Path]:
+    """Documents in the index that are, or depend on, a changed file.
+
+    Documents that no longer exist, such as ones the changes deleted, are
+    left out.
+    """
+    changed_keys = {vault_key(vault_root, path) for path in changed}
+    documents = (
+        vault_root / document.lstrip("/")
+        for document, dependencies in load(vault_root).items()
+        if document in changed_keys or changed_keys.intersection(dependencies)
+    )
+    return sorted(d for d in documents if d.exists())
+
+
+def changed_files_base(directory: Path) -> Path:
+    """The directory paths in a list of changed files are relative to.
+
+    `git diff` names files relative to the top of the repository, wherever
+    it's run from, so that is used when `directory` is in a repository.
+    """
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--show-toplevel"],  # noqa: S607
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return directory
+    return Path(result.stdout.strip())
+
+
+def parse_changed_files(text: str, base: Path) -> list[Path]:
+    """Paths named by a file list or `git diff` output.
+
+    Accepts one path per line, `git diff --name-only` and
+    `git diff --name-status` output, or a full `git diff`. Relative paths
+    are resolved against `base`.
+
+    >>> def changed(text):
+    ...     return [
+    ...         p.as_posix()
+    ...         for p in parse_changed_files(text, Path("/v"))
+    ...     ]
+    >>> changed("a.md\\nsub/b.png\\n")
+    ['/v/a.md', '/v/sub/b.png']
+
+    >>> changed("M\\ta.md\\nR100\\told.md\\tnew.md\\n")
+    ['/v/a.md', '/v/old.md', '/v/new.md']
+
+    >>> diff = (
+    ...     "diff --git a/a.md b/a.md\\n"
+    ...     "--- a/a.md\\n"
+    ...     "+++ b/a.md\\n"
+    ...     "@@ -1 +1 @@\\n"
+    ...     "-old line\\n"
+    ...     "+new line\\n"
+    ...     "diff --git a/gone.md b/gone.md\\n"
+    ...     "--- a/gone.md\\n"
+    ...     "+++ /dev/null\\n"
+    ... )
+    >>> changed(diff)
+    ['/v/a.md', '/v/gone.md']
+    """
+    lines = text.splitlines()
+    is_diff = any(line.startswith("diff --git ") for line in lines)
+    names = []
+    for line in lines:
+        if is_diff:
+            if line.startswith(("--- a/", "+++ b/")):
+                names.append(line[6:])
+        elif re.match(NAME_STATUS_REGEX, line):
+            names.extend(line.split("\t")[1:])
+        elif line.strip():
+            names.append(line.strip())
+
+    paths = []
+    for name in names:
+        path = base / name
+        if path not in paths:
+            paths.append(path)
+    return paths
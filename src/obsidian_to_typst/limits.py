@@ -0,0 +1,184 @@
+"""Wall clock and memory budgets for converting and compiling documents.
+
+Typst runs as a child process, so it is limited with a timeout and, on
+Linux, an address space limit applied from outside once it has started. Conversion runs in
+Python, where a runaway conversion can neither be interrupted nor have its
+memory capped from another thread. When limits are set, each conversion
+runs in a child process of its own instead.
+"""
+
+import functools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import sys
+from collections.abc import Callable
+from typing import Any
+
+from pydantic.dataclasses import dataclass
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Windows
+    resource = None
+
+_logger = logging.getLogger(__name__)
+
+# Modules the fork server imports once, so each conversion process starts
+# without importing them again.
+PRELOAD = ["obsidian_to_typst.obsidian_to_typst"]
+
+
+class LimitExceeded(Exception):
+    pass
+
+
+@dataclass
+class Limits:
+    """Budget for each conversion, and for each typst run, of a document."""
+
+    timeout: float | None = None
+    # MiB of address space.
+    memory: int | None = None
+
+    def __bool__(self) -> bool:
+        return self.timeout is not None or self.memory is not None
+
+
+def call_limited(
+    function: Callable[..., Any],
+    args: tuple,
+    limits: Limits,
+    what: str,
+) -> Any:  # noqa: ANN401
+    """Call `function(*args)` in a child process, within `limits`.
+
+    `function`, `args` and the result must be picklable. Exceptions raised
+    by `function` are raised again here.
+    """
+    context = _context()
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_call_in_child,
+        args=(sender, function, args, limits.memory, what),
+        daemon=True,
+    )
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(limits.timeout):
+            raise timed_out(what, limits)
+        ok, value = receiver.recv()
+    except EOFError:
+        process.join()
+        msg = f"{what} died with exit code {process.exitcode}"
+        if limits.memory is not None:
+            msg += f", likely over the memory limit of {limits.memory} MiB"
+        raise LimitExceeded(msg) from None
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+    if ok:
+        return value
+    raise value
+
+
+def _call_in_child(
+    sender: multiprocessing.connection.Connection,
+    function: Callable[..., Any],
+    args: tuple,
+    memory: int | None,
+    what: str,
+) -> None:  # pragma: no cover
+    set_memory_limit(memory)
+    try:
+        result = (True, function(*args))
+    except MemoryError:
+        msg = f"{what} ran out of memory, over the limit of {memory} MiB"
+        result = (False, LimitExceeded(msg))
+    except Exception as e:  # noqa: BLE001
+        result = (False, e)
+    try:
+        payload = pickle.dumps(result)
+    except Exception:  # noqa: BLE001
+        # Not every exception can be pickled; keep its message at least.
+        error = RuntimeError(f"{type(result[1]).__name__}: {result[1]}")
+        payload = pickle.dumps((False, error))
+    sender.send_bytes(payload)
+
+
+def set_memory_limit(memory: int | None) -> None:
+    """Limit the address space of this process to `memory` MiB."""
+    if memory is None:
+        return
+    if resource is None:  # pragma: no cover
+        _warn_no_memory_limit()
+        return
+    _soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (_address_space(memory, hard), hard))
+
+
+def limit_process(pid: int, limits: Limits | None) -> None:
+    """Limit the address space of the running child process `pid`.
+
+    The limit is applied from the parent once the child has started, as a
+    `preexec_fn` would run Python between fork and exec, which can deadlock
+    a parent with threads.
+    """
+    if limits is None or limits.memory is None:
+        return
+    if not hasattr(resource, "prlimit"):  # pragma: no cover
+        _warn_no_memory_limit()
+        return
+    try:
+        _soft, hard = resource.prlimit(pid, resource.RLIMIT_AS)
+        limit = _address_space(limits.memory, hard)
+        resource.prlimit(pid, resource.RLIMIT_AS, (limit, hard))
+    except ProcessLookupError:  # pragma: no cover
+        # Already finished, so there's nothing left to limit.
+        pass
+
+
+def _address_space(memory: int, hard: int) -> int:
+    limit = memory * 2**20
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    return limit
+
+
+def timed_out(what: str, limits: Limits) -> LimitExceeded:
+    return LimitExceeded(f"{what} took longer than {limits.timeout} s")
+
+
+def check_signal(what: str, returncode: int, limits: Limits) -> None:
+    """Raise `LimitExceeded` if `what` was killed while its memory was limited.
+
+    Running out of address space usually kills a process with a signal,
+    which `returncode` reports as negative.
+    """
+    if returncode < 0 and limits.memory is not None:
+        msg = (
+            f"{what} was killed by signal {-returncode}, likely over the "
+            f"memory limit of {limits.memory} MiB"
+        )
+        raise LimitExceeded(msg)
+
+
+@functools.cache
+def _warn_no_memory_limit() -> None:  # pragma: no cover
+    _logger.warning("Memory limits are not supported on %s", sys.platform)
+
+
+@functools.cache
+def _context() -> multiprocessing.context.BaseContext:
+    # Forking the converter, which has threads of its own, is unsafe. A
+    # fork server is a single threaded process to fork from instead.
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")  # pragma: no cover
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(PRELOAD)
+    return context
@@ -0,0 +1,158 @@
+"""Counters describing a run, reported once it ends.
+
+Conversion and compilation add to module level counters as they go. At the
+end of a run the counters are summarised into a JSON report and, for
+Prometheus' textfile collector, the same figures in its text format.
+"""
+
+import collections
+import contextlib
+import datetime as dt
+import json
+import re
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+PROMETHEUS_PREFIX = "obsidian_to_typst_"
+
+# Counted on the converter thread and the thread running typst at once.
+_LOCK = threading.Lock()
+COUNTERS: collections.Counter[str] = collections.Counter()
+
+
+def count(name: str, amount: float = 1) -> None:
+    with _LOCK:
+        COUNTERS[name] += amount
+
+
+@contextlib.contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Add the seconds spent in the block to the `<name>_seconds` counter."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(f"{name}_seconds", time.perf_counter() - start)
+
+
+def hit(name: str, found: bool) -> None:
+    count(f"{name}_hits" if found else f"{name}_misses")
+
+
+def snapshot() -> dict[str, float]:
+    with _LOCK:
+        return dict(COUNTERS)
+
+
+def merge(counters: dict[str, float]) -> None:
+    """Add counters taken in another process."""
+    with _LOCK:
+        COUNTERS.update(counters)
+
+
+def reset() -> None:
+    with _LOCK:
+        COUNTERS.clear()
+
+
+def report(
+    started: dt.datetime,
+    seconds: float,
+    counters: dict[str, float] | None = None,
+) -> dict[str, Any]:
+    """Summarise `counters`, by default the current ones, as a run report.
+
+    >>> started = dt.datetime(2026, 1, 2, tzinfo=dt.UTC)
+    >>> counters = {
+    ...     "documents": 4,
+    ...     "embedded_notes": 6,
+    ...     "cache_x_hits": 3,
+    ...     "cache_x_misses": 1,
+    ... }
+    >>> r = report(started, 2.0, counters)
+    >>> (
+    ...     r["documents_per_second"],
+    ...     r["embeds_per_document"],
+    ...     r["hit_rates"],
+    ... )
+    (2.0, 1.5, {'cache_x': 0.75})
+    """
+    counters = snapshot() if counters is None else counters
+    documents = counters.get("documents", 0)
+    hit_rates = {}
+    for name, hits in sorted(counters.items()):
+        if name.endswith("_hits"):
+            cache = name.removesuffix("_hits")
+            lookups = hits + counters.get(f"{cache}_misses", 0)
+            hit_rates[cache] = hits / lookups if lookups else 0.0
+    return {
+        "started": started.isoformat(),
+        "seconds": seconds,
+        "documents_per_second": documents / seconds if seconds else 0.0,
+        "embeds_per_document": (
+            counters.get("embedded_notes", 0) / documents if documents else 0.0
+        ),
+        "hit_rates": hit_rates,
+        "counters": dict(sorted(counters.items())),
+    }
+
+
+def prometheus_text(run_report: dict[str, Any]) -> str:
+    """`run_report` in Prometheus' text exposition format.
+
+    >>> print(
+    ...     prometheus_text(
+    ...         {
+    ...             "seconds": 2.0,
+    ...             "hit_rates": {"cache_find-file": 0.5},
+    ...             "counters": {"documents": 4},
+    ...         }
+    ...     ),
+    ...     end="",
+    ... )
+    # TYPE obsidian_to_typst_seconds gauge
+    obsidian_to_typst_seconds 2.0
+    # TYPE obsidian_to_typst_hit_rate gauge
+    obsidian_to_typst_hit_rate{cache="cache_find-file"} 0.5
+    # TYPE obsidian_to_typst_documents gauge
+    obsidian_to_typst_documents 4
+    """
+    lines = []
+    for name, value in run_report.items():
+        if isinstance(value, int | float):
+            lines += gauge(name, value)
+    for cache, rate in run_report["hit_rates"].items():
+        lines += gauge("hit_rate", rate, f'{{cache="{cache}"}}')
+    for name, value in run_report["counters"].items():
+        lines += gauge(name, value)
+    # Each metric is declared once, before its first sample.
+    declared = set()
+    text = ""
+    for line in lines:
+        if line.startswith("#"):
+            if line in declared:
+                continue
+            declared.add(line)
+        text += line + "\n"
+    return text
+
+
+def gauge(name: str, value: float, labels: str = "") -> list[str]:
+    metric = PROMETHEUS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+    return [f"# TYPE {metric} gauge", f"{metric}{labels} {value}"]
+
+
+def write_report(
+    run_report: dict[str, Any], path: Path, prometheus: Path | None = None
+) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(run_report, indent=2) + "\n", encoding="UTF-8")
+    if prometheus is not None:
+        # The textfile collector may read at any moment, so never let it see
+        # a partly written file.
+        temp = prometheus.with_name(prometheus.name + ".tmp")
+        temp.write_text(prometheus_text(run_report), encoding="UTF-8")
+        temp.replace(prometheus)
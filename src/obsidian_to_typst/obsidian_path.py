@@ -1,8 +1,23 @@
 import os
+from collections.abc import Iterable
 from pathlib import Path
 
+from obsidian_to_typst import cache_store, metrics, vault_index
+
 VAULT_ROOT: Path | None = None
 TEMP_FOLDER: Path | None = None
+CACHE_FOLDER_NAME = ".obsidian-to-typst"
+FIND_FILE_NAMESPACE = "find-file"
+
+# Resident processes convert many documents against the same vault, so
+# index the vault once instead of walking it for every file.
+_INDEXES: dict[Path, vault_index.VaultIndex] = {}
+# Files found missing since the vault was last walked, so that a broken
+# link costs one walk of the vault rather than one for every occurrence.
+_MISSING: set[str] = set()
+# Locations this process knows the cache holds, by vault and file name, so
+# that repeated lookups don't rewrite them.
+_CACHED: dict[tuple[Path, str], str] = {}
 
 
 def format_path(path: Path) -> str:
@@ -10,12 +25,81 @@ def format_path(path: Path) -> str:
 
 
 def find_file(file_name: str) -> Path:  # pragma: no cover
-    for root, _dirs, files in os.walk(VAULT_ROOT):
-        if file_name in files:
-            full_path: Path = Path(root) / file_name
-            return full_path
-    msg = f"Unable to locate `{file_name}` under `{VAULT_ROOT}`"
-    raise FileNotFoundError(msg)
+    found = find_files([file_name])[file_name]
+    if found is None:
+        msg = f"Unable to locate `{file_name}` under `{VAULT_ROOT}`"
+        raise FileNotFoundError(msg)
+    return found
+
+
+def find_files(file_names: Iterable[str]) -> dict[str, Path | None]:
+    """Locate each of `file_names`, walking the vault at most once.
+
+    Names that can't be found map to `None`, and are remembered as missing
+    until the vault is walked again or `forget_missing` is called.
+    """
+    found: dict[str, Path | None] = dict.fromkeys(file_names)
+    names = [name for name in found if name not in _MISSING]
+    index = _INDEXES.get(VAULT_ROOT)
+    if index is None:
+        # Skip indexing the vault when earlier runs found every file.
+        names = [name for name in names if not _find_cached(name, found)]
+        if not names:
+            return found
+        index = index_vault()
+        names = _find_indexed(index, names, found)
+    else:
+        names = _find_indexed(index, names, found)
+        if names:
+            # Files were added, moved or removed since the vault was indexed.
+            names = _find_indexed(index_vault(), names, found)
+    _MISSING.update(names)
+    return found
+
+
+def _find_cached(file_name: str, found: dict[str, Path | None]) -> bool:
+    cached = cache_store.get(VAULT_ROOT, FIND_FILE_NAMESPACE, file_name)
+    if cached is None or not (VAULT_ROOT / cached).exists():
+        return False
+    _CACHED[VAULT_ROOT, file_name] = cached
+    found[file_name] = VAULT_ROOT / cached
+    return True
+
+
+def _find_indexed(
+    index: vault_index.VaultIndex,
+    file_names: list[str],
+    found: dict[str, Path | None],
+) -> list[str]:
+    """Look `file_names` up in `index`, returning the ones not found."""
+    missing = []
+    for file_name in file_names:
+        path = index.find(file_name)
+        found_path = path is not None and path.exists()
+        metrics.hit("vault_index", found=found_path)
+        if not found_path:
+            missing.append(file_name)
+            continue
+        found[file_name] = path
+        location = format_path(path.relative_to(VAULT_ROOT))
+        if _CACHED.get((VAULT_ROOT, file_name)) != location:
+            cache_store.put(
+                VAULT_ROOT, FIND_FILE_NAMESPACE, file_name, location
+            )
+            _CACHED[VAULT_ROOT, file_name] = location
+    return missing
+
+
+def forget_missing() -> None:
+    _MISSING.clear()
+
+
+def index_vault() -> vault_index.VaultIndex:
+    metrics.count("vault_walks")
+    index = vault_index.VaultIndex.build(VAULT_ROOT, [CACHE_FOLDER_NAME])
+    _INDEXES[VAULT_ROOT] = index
+    _MISSING.clear()
+    return index
 
 
 def rel_path(path: Path) -> Path:
@@ -27,3 +111,12 @@ def root_path(path: Path) -> str:
     root = VAULT_ROOT.resolve()
     rel_path = os.path.relpath(path, root)
     return "/" + format_path(Path(rel_path))
+
+
+def cache_dir() -> Path:
+    """Folder for files cached between runs.
+
+    It lives inside the vault so typst, which is confined to the vault with
+    `--root`, can read cached files.
+    """
+    return VAULT_ROOT / CACHE_FOLDER_NAME
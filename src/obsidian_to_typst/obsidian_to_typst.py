@@ -1,8 +1,19 @@
+import asyncio
+import contextlib
+import dataclasses
+import datetime as dt
+import functools
 import logging
+import os
 import re
 import shutil
 import subprocess
+import sys
+import threading
+import time
+from collections.abc import Iterator
 from pathlib import Path
+from typing import Literal
 
 import click
 import colorama
@@ -10,92 +21,866 @@
 import coloredlogs
 import pydantic
 
-from obsidian_to_typst import obsidian_path, process_markdown
+from obsidian_to_typst import (
+    cache_store,
+    daemon,
+    dependency_index,
+    limits,
+    metrics,
+    obsidian_path,
+    pipeline,
+    prefetch,
+    prefilter,
+    preview,
+    process_markdown,
+)
 
 _logger = logging.getLogger(__name__)
 
+# Conversion runs against module level state in `process_markdown` and
+# `obsidian_path`, so only one document may be converted at a time.
+# Compiling with typst is free to run concurrently.
+_CONVERSION_LOCK = threading.Lock()
+_DOCUMENT_LOCKS: dict[Path, threading.Lock] = {}
+_DOCUMENT_LOCKS_LOCK = threading.Lock()
+
+STDIN = Path("-")
+STDIN_FILE_NAME = "stdin.md"
+EXPORT_FORMATS = ("pdf", "png", "svg")
+RUN_REPORT_FILE_NAME = "last-run.json"
+
+
+@pydantic.dataclasses.dataclass
+class RenderedDocument:
+    body: str
+    typst: str
+    dependencies: set[Path]
+
+
+@pydantic.dataclasses.dataclass
+class Export:
+    """The files typst exports each document to."""
+
+    formats: tuple[Literal["pdf", "png", "svg"], ...] = ("pdf",)
+    ppi: int | None = None
+    pages: str | None = None
+
+
+class DefaultCommandGroup(click.Group):
+    """Run `convert` unless the first argument names another command."""
+
+    default_command = "convert"
+
+    def parse_args(self, ctx: click.Context, args: list[str]) -> list[str]:
+        group_args = [*self.commands, *ctx.help_option_names, "--version"]
+        if not args or args[0] not in group_args:
+            args = [self.default_command, *args]
+        return super().parse_args(ctx, args)
+
 
-@click.command
+@click.group(cls=DefaultCommandGroup)
 @click.version_option()
+def main() -> None:  # pragma: no cover
+    colorama.init()
+    colored_traceback.add_hook()
+    coloredlogs.install(level="INFO")
+
+
+@main.command
 @click.argument(
-    "filename",
-    type=click.Path(path_type=Path, resolve_path=True),
+    "filenames",
+    nargs=-1,
+    type=click.Path(path_type=Path, resolve_path=True, allow_dash=True),
 )
 @click.option(
     "-t",
     "--template",
     type=click.Path(path_type=Path, resolve_path=True),
 )
+@click.option(
+    "--stdout",
+    type=click.Choice(["pdf", "typst"]),
+    help="Write the PDF or the typst source to stdout, and nothing to disk. "
+    "The default when FILENAME is `-`.",
+)
+@click.option(
+    "--preview",
+    "preview_target",
+    metavar="HEADING|LINE",
+    help="Compile only the section with this heading, or containing this "
+    "line, to `output/<name>.preview.pdf`.",
+)
+@click.option(
+    "--preview-format",
+    type=click.Choice(["pdf", "png"]),
+    default="pdf",
+    show_default=True,
+    help="Compile the preview to a PDF, or a PNG per page.",
+)
+@click.option(
+    "--format",
+    "formats",
+    default="pdf",
+    show_default=True,
+    callback=lambda _ctx, _param, value: parse_formats(value),
+    help="Comma separated formats to export each document to, from "
+    f"{', '.join(EXPORT_FORMATS)}. PNG and SVG are exported a file per "
+    "page, to `output/<name>-<page>.<format>`.",
+)
+@click.option(
+    "--ppi",
+    type=click.IntRange(min=1),
+    help="Pixels per inch of PNG exports.  Defaults to typst's default.",
+)
+@click.option(
+    "--pages",
+    help="Export only these pages, such as `1,3-5`.",
+)
+@click.option(
+    "--code-side-file-lines",
+    type=click.IntRange(min=1),
+    help="Move code blocks with at least this many lines into side files "
+    "loaded with typst's `read()`.",
+)
+@click.option(
+    "--pdf-embed",
+    type=click.Choice(["pages", "loop", "split"]),
+    default="pages",
+    show_default=True,
+    help="Embed PDFs with one `#image` per page, a typst loop over the "
+    "pages, or a loop over pages split once into the vault's cache.  "
+    "`split` falls back to `loop` with `--stdout`.",
+)
+@click.option(
+    "--max-embed-depth",
+    type=click.IntRange(min=0),
+    default=32,
+    show_default=True,
+    help="How deeply notes may be embedded in each other.",
+)
+@click.option(
+    "--max-embed-size",
+    type=click.IntRange(min=0),
+    help="Limit on the total characters of markdown embedded into one "
+    "document.",
+)
+@click.option(
+    "--changed-from",
+    type=click.Path(path_type=Path, allow_dash=True, dir_okay=False),
+    help="Also convert every previously converted document that depends "
+    "on a file listed in this file. Takes a list of paths or `git diff` "
+    "output, relative to the top of the git repository, or to the working "
+    "directory outside of one; `-` reads stdin.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Print the documents that would be converted, and stop.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=lambda: os.cpu_count() or 1,
+    show_default="the number of CPUs",
+    help="How many typst processes may run at once.",
+)
+@click.option(
+    "--fail-fast",
+    is_flag=True,
+    help="Stop converting documents after the first failure.",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    metavar="SECONDS",
+    help="Stop converting a document, or a typst run compiling it, after "
+    "this many seconds, and report it as failed.",
+)
+@click.option(
+    "--memory-limit",
+    type=click.IntRange(min=1),
+    metavar="MIB",
+    help="Limit the memory of each document's conversion, and of each typst "
+    "run, to this many MiB of address space.  Not supported on Windows.",
+)
+@click.option(
+    "--report",
+    "report_path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    help="Write a JSON report of the run's throughput, sizes and cache hit "
+    f"rates here.  Defaults to `{obsidian_path.CACHE_FOLDER_NAME}/"
+    f"{RUN_REPORT_FILE_NAME}` in the vault, except with `--stdout`.",
+)
+@click.option(
+    "--prometheus",
+    "prometheus_path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    help="Also write the report in Prometheus' text format, for the node "
+    "exporter's textfile collector.",
+)
+@click.option(
+    "--daemon",
+    "daemon_address",
+    default=daemon.default_address,
+    show_default="$OBSIDIAN_TO_TYPST_DAEMON or a per-user socket",
+    help="Address of a running `serve` daemon to hand the work to.",
+)
+@click.option(
+    "--no-daemon",
+    is_flag=True,
+    help="Convert in this process even if a daemon is running.",
+)
 @pydantic.validate_call
-def main(filename: Path, template: Path | None) -> None:  # pragma: no cover
-    colorama.init()
-    colored_traceback.add_hook()
-    coloredlogs.install(level="INFO")
+def convert(  # noqa: PLR0913, PLR0917
+    filenames: tuple[Path, ...],
+    template: Path | None,
+    stdout: str | None,
+    preview_target: str | None,
+    preview_format: str,
+    formats: tuple[str, ...],
+    ppi: int | None,
+    pages: str | None,
+    code_side_file_lines: int | None,
+    pdf_embed: str,
+    max_embed_depth: int,
+    max_embed_size: int | None,
+    changed_from: Path | None,
+    dry_run: bool,
+    jobs: int,
+    fail_fast: bool,
+    timeout: float | None,
+    memory_limit: int | None,
+    report_path: Path | None,
+    prometheus_path: Path | None,
+    daemon_address: str,
+    no_daemon: bool,
+) -> None:  # pragma: no cover
+    """Convert each of FILENAMES to a PDF in `output/` next to it.
+
+    Use `-` as the only FILENAME to read markdown from stdin, with the vault
+    located from the working directory.
+    """
+    options = process_markdown.Options(
+        code_side_file_lines=code_side_file_lines,
+        pdf_embed=pdf_embed,
+        max_embed_depth=max_embed_depth,
+        max_embed_size=max_embed_size,
+    )
+    export = Export(formats=formats, ppi=ppi, pages=pages)
+    budget = limits.Limits(timeout=timeout, memory=memory_limit)
+    documents = select_documents(filenames, changed_from, stdout)
+    if dry_run:
+        for document in documents:
+            click.echo(document)
+        return
+    if not documents:
+        _logger.info("No documents depend on the changed files")
+        return
+
+    to_stdout = documents[0] == STDIN or bool(stdout)
+    report_path = report_path or default_report_path(
+        documents[0], to_stdout, prometheus_path
+    )
+    with run_report(report_path, prometheus_path):
+        try:
+            if to_stdout:
+                stdout_main(documents[0], template, stdout or "pdf", options)
+                return
+            if preview_target:
+                for filename in documents:
+                    preview_main(
+                        filename,
+                        template,
+                        preview_target,
+                        preview_format,
+                        options,
+                        budget,
+                    )
+                return
+            # A daemon saves starting up for a single document. Batches
+            # amortise that anyway, and overlap conversion with typst runs.
+            if (
+                len(documents) == 1
+                and not no_daemon
+                and compile_with_daemon(
+                    daemon_address,
+                    documents[0],
+                    template,
+                    options,
+                    export,
+                    budget,
+                )
+            ):
+                return
+            batch_main(
+                documents, template, options, export, budget, jobs, fail_fast
+            )
+        except Exception as _e:
+            _logger.critical("Failed to export document to PDF using typst")
+            raise
+
+
+@main.command
+@click.option(
+    "--address",
+    default=daemon.default_address,
+    show_default="$OBSIDIAN_TO_TYPST_DAEMON or a per-user socket",
+    help="Unix socket path, or HOST:PORT to listen on localhost TCP.  TCP "
+    "is not authenticated, so any local user can connect.",
+)
+@pydantic.validate_call
+def serve(address: str) -> None:  # pragma: no cover
+    """Run a resident daemon that converts documents on request."""
+    daemon.serve(address, handle_request)
+
+
+@main.group
+def cache() -> None:
+    """Inspect or empty the cache in the vault's `.obsidian-to-typst`."""
+
+
+@cache.command("stats")
+def cache_stats() -> None:
+    """Show the entries and size of each part of the cache."""
+    vault_root = get_vault_root(Path.cwd())
+    click.echo(f"{cache_store.cache_path(vault_root)}")
+    for stats in cache_store.stats(vault_root):
+        click.echo(
+            f"{stats.namespace}: {stats.entries} entries, {stats.size} bytes"
+        )
+    pages = list(pdf_pages_dir(vault_root).glob("*/*.pdf"))
+    size = sum(page.stat().st_size for page in pages)
+    click.echo(
+        f"{process_markdown.PDF_PAGES_FOLDER_NAME}: {len(pages)} pages, "
+        f"{size} bytes"
+    )
+
+
+@cache.command("clear")
+@click.option(
+    "--namespace",
+    help="Clear only this part of the cache, as named by `cache stats`.",
+)
+@pydantic.validate_call
+def cache_clear(namespace: str | None) -> None:
+    """Empty the cache."""
+    vault_root = get_vault_root(Path.cwd())
+    if namespace in {None, process_markdown.PDF_PAGES_FOLDER_NAME}:
+        shutil.rmtree(pdf_pages_dir(vault_root), ignore_errors=True)
+    if namespace != process_markdown.PDF_PAGES_FOLDER_NAME:
+        removed = cache_store.clear(vault_root, namespace)
+        click.echo(f"Removed {removed} entries")
+
+
+def pdf_pages_dir(vault_root: Path) -> Path:
+    return (
+        vault_root
+        / obsidian_path.CACHE_FOLDER_NAME
+        / process_markdown.PDF_PAGES_FOLDER_NAME
+    )
+
+
+def default_report_path(
+    document: Path, to_stdout: bool, prometheus: Path | None
+) -> Path | None:  # pragma: no cover
+    """Where to report on a run converting `document`, if anywhere.
+
+    Runs writing to stdout leave the vault untouched, so aren't reported
+    unless a Prometheus file is asked for.
+    """
+    if to_stdout and prometheus is None:
+        return None
+    vault_root = get_vault_root(Path.cwd() if document == STDIN else document)
+    return vault_root / obsidian_path.CACHE_FOLDER_NAME / RUN_REPORT_FILE_NAME
+
+
+@contextlib.contextmanager
+def run_report(
+    path: Path | None, prometheus: Path | None = None
+) -> Iterator[None]:
+    """Count what happens in the block, and write a report of it to `path`.
+
+    Failing to write the report is logged, rather than failing the run.
+    """
+    started = dt.datetime.now(dt.UTC)
+    start = time.perf_counter()
+    metrics.reset()
     try:
-        app_main(filename, template)
-    except Exception as _e:
-        _logger.critical("Failed to export document to PDF using typst")
+        yield
+    finally:
+        summary = metrics.report(started, time.perf_counter() - start)
+        if path is not None:
+            try:
+                metrics.write_report(summary, path, prometheus)
+            except OSError as e:
+                _logger.warning("Failed to write the run report: %s", e)
+            else:
+                _logger.info("Wrote run report to `%s`", path)
+
+
+def parse_formats(value: str) -> tuple[str, ...]:
+    """
+    >>> parse_formats("pdf, png,pdf")
+    ('pdf', 'png')
+    """
+    formats = tuple(
+        dict.fromkeys(f.strip().lower() for f in value.split(",") if f.strip())
+    )
+    unknown = [f for f in formats if f not in EXPORT_FORMATS]
+    if unknown or not formats:
+        msg = (
+            f"Unknown formats `{', '.join(unknown)}`, expected some of "
+            f"{', '.join(EXPORT_FORMATS)}"
+        )
+        raise click.BadParameter(msg)
+    return formats
+
+
+def select_documents(
+    filenames: tuple[Path, ...], changed_from: Path | None, stdout: str | None
+) -> list[Path]:  # pragma: no cover
+    documents = list(dict.fromkeys(filenames))
+    if changed_from:
+        documents.extend(
+            d for d in changed_documents(changed_from) if d not in documents
+        )
+    elif not documents:
+        msg = "Missing FILENAMES, or --changed-from"
+        raise click.UsageError(msg)
+    if (STDIN in documents or stdout) and len(documents) != 1:
+        msg = "Only a single document can be written to stdout"
+        raise click.UsageError(msg)
+    return documents
+
+
+def changed_documents(changed_from: Path) -> list[Path]:  # pragma: no cover
+    if changed_from == STDIN:
+        text = sys.stdin.read()
+    else:
+        with changed_from.open(encoding="UTF-8") as f:
+            text = f.read()
+    changed = dependency_index.parse_changed_files(
+        text, dependency_index.changed_files_base(Path.cwd())
+    )
+    documents = dependency_index.affected_documents(
+        get_vault_root(Path.cwd()), changed
+    )
+    _logger.info(
+        "%s changed files affect %s documents", len(changed), len(documents)
+    )
+    return documents
+
+
+def compile_with_daemon(  # noqa: PLR0913, PLR0917
+    address: str,
+    filename: Path,
+    template: Path | None,
+    options: process_markdown.Options,
+    export: Export,
+    budget: limits.Limits,
+) -> bool:  # pragma: no cover
+    response = daemon.request(
+        address,
+        {
+            "command": "compile",
+            "path": str(filename),
+            "template": str(template) if template else None,
+            "options": dataclasses.asdict(options),
+            "export": dataclasses.asdict(export),
+            "limits": dataclasses.asdict(budget),
+        },
+    )
+    if response is None:
+        return False
+    metrics.count("documents")
+    if not response["ok"]:
+        metrics.count("documents_failed")
+        raise daemon.DaemonError(response["error"])
+    metrics.count("daemon_documents")
+    for output in response["outputs"]:
+        _logger.info("Daemon wrote `%s`", output)
+    return True
+
+
+def handle_request(request: dict) -> dict:
+    command = request.get("command")
+    if command == "ping":
+        return {"ok": True}
+
+    filename = Path(request["path"]).resolve()
+    template = request.get("template")
+    template = Path(template).resolve() if template else None
+    options = process_markdown.Options(**request.get("options", {}))
+    if command == "convert":
+        with _document_lock(filename):
+            temp_wrapper = stage_document(filename, template, options)
+            typst = temp_wrapper.read_text(encoding="UTF-8")
+        return {"ok": True, "typst": typst}
+    if command == "compile":
+        export = Export(**request.get("export", {}))
+        budget = limits.Limits(**request.get("limits", {}))
+        outputs = app_main(filename, template, options, export, budget)
+        return {"ok": True, "outputs": [str(o) for o in outputs]}
+    return {"ok": False, "error": f"Unknown command `{command}`"}
+
+
+@pydantic.validate_call
+def app_main(
+    filename: Path,
+    template: Path | None,
+    options: process_markdown.Options | None = None,
+    export: Export | None = None,
+    budget: limits.Limits | None = None,
+) -> list[Path]:  # pragma: no cover
+    """Convert and export `filename`, returning the files written."""
+    export = export or Export()
+    metrics.count("documents")
+    try:
+        with _document_lock(filename):
+            temp_wrapper = stage_limited(filename, template, options, budget)
+            runs = export_runs(filename, temp_wrapper, export, budget)
+            asyncio.run(pipeline.run_typst_all(filename.name, runs))
+            if "pdf" in export.formats:
+                publish_pdf(filename, temp_wrapper)
+    except Exception:
+        metrics.count("documents_failed")
         raise
+    return [p for f in export.formats for p in exported_files(filename, f)]
 
 
 @pydantic.validate_call
-def app_main(filename: Path, template: Path | None) -> None:  # pragma: no cover
-    # pylint: disable=too-many-locals
-    obsidian_path.VAULT_ROOT = get_vault_root(filename)
+def batch_main(  # noqa: PLR0913, PLR0917
+    documents: list[Path],
+    template: Path | None,
+    options: process_markdown.Options,
+    export: Export,
+    budget: limits.Limits,
+    jobs: int,
+    fail_fast: bool,
+) -> None:  # pragma: no cover
+    """Convert and compile `documents`, overlapping the two."""
+
+    def stage(filename: Path) -> pipeline.StagedDocument:
+        temp_wrapper = stage_limited(filename, template, options, budget)
+        publish = None
+        if "pdf" in export.formats:
+            publish = functools.partial(publish_pdf, filename, temp_wrapper)
+        return pipeline.StagedDocument(
+            runs=export_runs(filename, temp_wrapper, export, budget),
+            publish=publish,
+        )
+
+    failures = asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs, fail_fast)
+    )
+    if failures:
+        names = ", ".join(f"`{f.document.name}`" for f in failures)
+        msg = f"{len(failures)} of {len(documents)} documents failed: {names}"
+        raise Exception(msg)  # noqa: TRY002
 
-    # pylint: disable=protected-access
+
+@pydantic.validate_call
+def stdout_main(
+    filename: Path,
+    template: Path | None,
+    stdout: str,
+    options: process_markdown.Options | None = None,
+) -> None:  # pragma: no cover
+    if filename == STDIN:
+        text = sys.stdin.read()
+        filename = Path.cwd() / STDIN_FILE_NAME
+    else:
+        with filename.open(mode="r", encoding="utf-8") as f:
+            text = f.read()
+
+    cache_store.READ_ONLY = True
+    try:
+        rendered = render_document(filename, text, template, None, options)
+    finally:
+        cache_store.READ_ONLY = False
+    if stdout == "typst":
+        sys.stdout.write(rendered.typst)
+        return
+
+    vault_root = get_vault_root(filename)
+    args = ["typst", "compile", "--root", vault_root, "-", "-"]
+    _logger.info("Running `%s`", " ".join([str(a) for a in args]))
+    try:
+        subprocess.run(  # noqa: S603
+            args,
+            check=True,
+            input=rendered.typst.encode("UTF-8"),
+            stdout=sys.stdout.buffer,
+            cwd=vault_root,
+        )
+    except FileNotFoundError:
+        _logger.error("Failed to call typst.  Ensure typst is installed")
+        raise
+
+
+@pydantic.validate_call
+def preview_main(  # noqa: PLR0913, PLR0917
+    filename: Path,
+    template: Path | None,
+    target: str,
+    output_format: str,
+    options: process_markdown.Options | None = None,
+    budget: limits.Limits | None = None,
+) -> Path:  # pragma: no cover
+    temp_wrapper = stage_preview(filename, template, target, options)
+    out_dir = filename.parent / "output"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    page = "-{p}" if output_format == "png" else ""
+    out_file = out_dir / f"{filename.stem}.preview{page}.{output_format}"
+    compile_typst(temp_wrapper, get_vault_root(filename), out_file, budget)
+    return out_file
+
+
+@pydantic.validate_call
+def stage_preview(
+    filename: Path,
+    template: Path | None,
+    target: str,
+    options: process_markdown.Options | None = None,
+) -> Path:
+    """Stage just the section of `filename` named by `target`.
+
+    Labels linked to from the section, but defined elsewhere in the
+    document, are stubbed out so that typst accepts the links.
+    """
     with filename.open(mode="r", encoding="utf-8") as f:
         text = f.read()
+    section = preview.extract_section(text, target)
 
-    title = get_title(text)
     temp_dir = filename.parent / "temp"
-    obsidian_path.TEMP_FOLDER = temp_dir
     temp_dir.mkdir(parents=True, exist_ok=True)
-    temp_file = temp_dir / "body.typ"
+    rendered = render_document(
+        filename, section, template, temp_dir, options, get_title(text)
+    )
+    temp_wrapper = temp_dir / f"{filename.stem}.preview.typ"
+    with temp_wrapper.open("w", encoding="UTF-8") as f:
+        f.write(rendered.typst + preview.missing_label_stubs(rendered.typst))
+    return temp_wrapper
 
-    process_markdown.init_state(temp_dir, filename)
-    typst = process_markdown.obsidian_to_typst(text)
-    with temp_file.open("w", encoding="UTF-8") as f:
-        f.write(typst)
 
-    typst_wrapper = (
-        template if template else Path(__file__).parent / "document.typ"
-    )
-    temp_wrapper = temp_dir / typst_wrapper.name
+@pydantic.validate_call
+def render_document(  # noqa: PLR0913, PLR0917
+    filename: Path,
+    text: str,
+    template: Path | None,
+    temp_dir: Path | None,
+    options: process_markdown.Options | None = None,
+    title: str | None = None,
+) -> RenderedDocument:
+    """Convert the markdown `text` of `filename` without writing any files.
+
+    The title defaults to the first line of `text`.
+    """
+    title = get_title(text) if title is None else title
+    with _CONVERSION_LOCK:
+        obsidian_path.VAULT_ROOT = get_vault_root(filename)
+        obsidian_path.TEMP_FOLDER = temp_dir
+        process_markdown.OPTIONS = options or process_markdown.Options()
+        process_markdown.init_state(temp_dir, filename)
+        process_markdown.STATE.prefetched = prefetch.prefetch(text)
+        typst = process_markdown.obsidian_to_typst(text)
+        dependencies = set(process_markdown.STATE.dependencies)
 
+    typst_wrapper = template or Path(__file__).parent / "document.typ"
     with typst_wrapper.open(encoding="UTF-8") as f:
         wrapper_text = f.read()
     wrapper_text = wrapper_text.replace("TheTitleOfTheDocument", title)
     wrapper_text += typst
+    return RenderedDocument(
+        body=typst, typst=wrapper_text, dependencies=dependencies
+    )
+
+
+@pydantic.validate_call
+def stage_document(
+    filename: Path,
+    template: Path | None,
+    options: process_markdown.Options | None = None,
+) -> Path:
+    """Convert `filename` and write the typst files `typst compile` needs.
+
+    Returns the path of the wrapper document to compile.
+    """
+    with filename.open(mode="r", encoding="utf-8") as f:
+        text = f.read()
 
+    temp_dir = filename.parent / "temp"
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    temp_file = temp_dir / f"{filename.stem}.body.typ"
+
+    with metrics.timed("conversion"):
+        rendered = render_document(filename, text, template, temp_dir, options)
+    metrics.count("markdown_bytes", len(text.encode("UTF-8")))
+    metrics.count("typst_bytes", len(rendered.typst.encode("UTF-8")))
+    with temp_file.open("w", encoding="UTF-8") as f:
+        f.write(rendered.body)
+
+    # Named after the document, so that documents sharing a folder can be
+    # compiled at the same time.
+    temp_wrapper = temp_dir / f"{filename.stem}.typ"
     with temp_wrapper.open("w", encoding="UTF-8") as f:
-        f.write(wrapper_text)
-
-    args = [
-        "typst",
-        "compile",
-        temp_wrapper,
-        "--root",
-        obsidian_path.VAULT_ROOT,
-    ]
+        f.write(rendered.typst)
+
+    dependency_index.record(
+        get_vault_root(filename), filename, rendered.dependencies
+    )
+    return temp_wrapper
+
+
+@pydantic.validate_call
+def stage_limited(
+    filename: Path,
+    template: Path | None,
+    options: process_markdown.Options | None = None,
+    budget: limits.Limits | None = None,
+) -> Path:
+    """`stage_document`, in a process of its own when `budget` is set."""
+    if not budget:
+        return stage_document(filename, template, options)
+    temp_wrapper, counters = limits.call_limited(
+        stage_and_count, (filename, template, options), budget, "conversion"
+    )
+    metrics.merge(counters)
+    return temp_wrapper
+
+
+def stage_and_count(
+    filename: Path,
+    template: Path | None,
+    options: process_markdown.Options | None = None,
+) -> tuple[Path, dict[str, float]]:
+    """`stage_document`, and the counters it added to, for another process."""
+    metrics.reset()
+    temp_wrapper = stage_document(filename, template, options)
+    return temp_wrapper, metrics.snapshot()
+
+
+def export_runs(
+    filename: Path,
+    temp_wrapper: Path,
+    export: Export,
+    budget: limits.Limits | None = None,
+) -> list[pipeline.TypstRun]:
+    """A typst run per format, all compiling the same staged document.
+
+    The PDF is compiled next to `temp_wrapper`, and published once it is
+    complete. Other formats are written straight to `output/`, replacing
+    the pages of earlier exports.
+    """
+    runs = []
+    for output_format in export.formats:
+        output = None
+        if output_format != "pdf":
+            output = export_path(filename, output_format)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            # Pages left from a longer export, or one of other pages, would
+            # otherwise be reported as written by this one.
+            for page in exported_files(filename, output_format):
+                page.unlink(missing_ok=True)
+        args = typst_args(
+            temp_wrapper, get_vault_root(filename), output, export
+        )
+        runs.append(
+            pipeline.TypstRun(args=args, cwd=temp_wrapper.parent, budget=budget)
+        )
+    return runs
+
+
+def export_path(filename: Path, output_format: str) -> Path:
+    """
+    >>> export_path(Path("notes/Widget.md"), "pdf").as_posix()
+    'notes/output/Widget.pdf'
+    >>> export_path(Path("notes/Widget.md"), "png").as_posix()
+    'notes/output/Widget-{p}.png'
+    """
+    page = "" if output_format == "pdf" else "-{p}"
+    return filename.parent / "output" / f"{filename.stem}{page}.{output_format}"
+
+
+def exported_files(filename: Path, output_format: str) -> list[Path]:
+    """The files exported from `filename` in `output_format`, in page order.
+
+    PNG and SVG exports are written a page per file, numbered from 1.
+    """
+    path = export_path(filename, output_format)
+    if output_format == "pdf":
+        return [path]
+    if not path.parent.is_dir():
+        return []
+    prefix, suffix = path.name.split("{p}")
+    pages = []
+    for page in path.parent.iterdir():
+        number = page.name.removeprefix(prefix).removesuffix(suffix)
+        if page.name.startswith(prefix) and number.isdigit():
+            pages.append((int(number), page))
+    return [page for _number, page in sorted(pages)]
+
+
+def typst_args(
+    temp_wrapper: Path,
+    vault_root: Path,
+    output: Path | None = None,
+    export: Export | None = None,
+) -> list[str]:
+    """
+    >>> typst_args(
+    ...     Path("Doc.typ"),
+    ...     Path("vault"),
+    ...     Path("Doc-{p}.png"),
+    ...     Export(ppi=300, pages="1-2"),
+    ... )[2:]
+    ['Doc.typ', 'Doc-{p}.png', '--root', 'vault', '--pages', '1-2', '--ppi', '300']
+    """
+    args = ["typst", "compile", str(temp_wrapper)]
+    if output is not None:
+        args.append(str(output))
+    args += ["--root", str(vault_root)]
+    if export is not None and export.pages:
+        args += ["--pages", export.pages]
+    is_png = output is not None and output.suffix == ".png"
+    if export is not None and export.ppi and is_png:
+        args += ["--ppi", str(export.ppi)]
+    return args
+
+
+def compile_typst(
+    temp_wrapper: Path,
+    vault_root: Path,
+    output: Path | None = None,
+    budget: limits.Limits | None = None,
+) -> None:  # pragma: no cover
+    args = typst_args(temp_wrapper, vault_root, output)
+    budget = budget or limits.Limits()
     _logger.info("Running `%s`", " ".join([str(a) for a in args]))
     try:
-        typst_result = subprocess.run(  # noqa: S603
-            args,
-            check=True,
-            capture_output=False,
-            cwd=temp_wrapper.parent,
-        )
+        process = subprocess.Popen(args, cwd=temp_wrapper.parent)  # noqa: S603
     except FileNotFoundError:
         _logger.error("Failed to call typst.  Ensure typst is installed")
         raise
-    if typst_result.returncode:
+    with process:
+        limits.limit_process(process.pid, budget)
+        try:
+            returncode = process.wait(budget.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            error = limits.timed_out("typst", budget)
+            raise error from None
+    limits.check_signal("typst", returncode, budget)
+    if returncode:
         _logger.error(
             "Typst failed to complete.  Document may not be setup correctly"
         )
         msg = "Subprocess Failed"
         raise Exception(msg)  # noqa: TRY002
 
+
+def publish_pdf(filename: Path, temp_wrapper: Path) -> Path:  # pragma: no cover
     temp_pdf = temp_wrapper.with_suffix(".pdf")
     out_dir = filename.parent / "output"
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -106,8 +891,17 @@ def app_main(filename: Path, template: Path | None) -> None:  # pragma: no cover
         msg = f"Failed to create PDF: `{out_pdf}`"
         logging.getLogger(__name__).error(msg)
         raise FileNotFoundError(msg) from None
+    return out_pdf
+
 
+def _document_lock(filename: Path) -> threading.Lock:
+    # Staging, compiling and publishing a document reuse the same files in
+    # its `temp` folder, so requests for one document must not interleave.
+    with _DOCUMENT_LOCKS_LOCK:
+        return _DOCUMENT_LOCKS.setdefault(filename, threading.Lock())
 
+
+@functools.cache
 def get_vault_root(path: Path) -> Path:  # pragma: no cover
     if (path / ".obsidian").exists():
         return path
@@ -120,8 +914,22 @@ def get_vault_root(path: Path) -> Path:  # pragma: no cover
     return get_vault_root(path.parent)
 
 
-def get_title(text: str) -> str:  # pragma: no cover
-    line = text.splitlines()[0]
+def get_title(text: str) -> str:
+    """The `title` in the frontmatter of `text`, or else its first line.
+
+    >>> get_title("---\\ntitle: Widgets\\n---\\n# Sprockets\\n")
+    'Widgets'
+    >>> get_title("---\\ntags: a\\n---\\n# Sprockets\\n")
+    'Sprockets'
+    """
+    title = prefilter.parse_frontmatter(text).get("title")
+    if title:
+        return title
+    _frontmatter, text, _first_line = prefilter.split_frontmatter(text)
+    lines = text.splitlines()
+    if not lines:
+        return ""
+    line = lines[0]
     m = re.match(r"(^#*)\s*(.*)", line)
     if not m:
         return None
@@ -0,0 +1,175 @@
+"""Convert and compile many documents, overlapping the two.
+
+Documents are converted one at a time, in order, on a worker thread, since
+conversion runs against module level state. Each converted document is
+then compiled by typst subprocesses while the next document is converted.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import subprocess
+import sys
+from collections.abc import Callable, Sequence
+from pathlib import Path
+
+from pydantic.dataclasses import dataclass
+
+from obsidian_to_typst import limits, metrics
+
+_logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TypstRun:
+    args: list[str]
+    cwd: Path
+    budget: limits.Limits | None = None
+
+
+@dataclass
+class StagedDocument:
+    """A converted document, and the typst runs that compile it."""
+
+    runs: list[TypstRun]
+    publish: Callable[[], object] | None = None
+
+
+@dataclass
+class Failure:
+    document: Path
+    stage: str
+    error: str
+
+
+Stage = Callable[[Path], StagedDocument]
+
+
+async def run_pipeline(
+    documents: Sequence[Path],
+    stage: Stage,
+    jobs: int,
+    fail_fast: bool,
+) -> list[Failure]:
+    """Convert and compile `documents`, returning the ones that failed.
+
+    `stage` converts a document and describes how to compile it. At most
+    `jobs` typst processes run at once, across all documents. With
+    `fail_fast`, the first failure cancels everything still running.
+    """
+    loop = asyncio.get_running_loop()
+    converter = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="convert"
+    )
+    typst_slots = asyncio.Semaphore(jobs)
+    failures: list[Failure] = []
+
+    async def run_document(document: Path) -> None:
+        metrics.count("documents")
+        step = "convert"
+        try:
+            staged = await loop.run_in_executor(converter, stage, document)
+            step = "typst"
+            await run_typst_all(document.name, staged.runs, typst_slots)
+            step = "publish"
+            if staged.publish is not None:
+                staged.publish()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _logger.error("Failed to %s `%s`: %s", step, document, e)
+            metrics.count("documents_failed")
+            failures.append(
+                Failure(document=document, stage=step, error=str(e))
+            )
+            if fail_fast:
+                raise
+
+    tasks = [asyncio.create_task(run_document(d)) for d in documents]
+    try:
+        _done, pending = await asyncio.wait(
+            tasks,
+            return_when=(
+                asyncio.FIRST_EXCEPTION if fail_fast else asyncio.ALL_COMPLETED
+            ),
+        )
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        converter.shutdown(wait=True, cancel_futures=True)
+    return failures
+
+
+async def run_typst_all(
+    name: str, runs: Sequence[TypstRun], slots: asyncio.Semaphore | None = None
+) -> None:
+    """Run the typst `runs` of one document at once, as `slots` allow.
+
+    The first run to fail cancels the others.
+    """
+
+    async def run_in_slot(run: TypstRun) -> None:
+        if slots is None:
+            await run_typst(name, run)
+            return
+        async with slots:
+            await run_typst(name, run)
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            for run in runs:
+                group.create_task(run_in_slot(run))
+    except ExceptionGroup as e:
+        raise e.exceptions[0] from None
+
+
+async def run_typst(name: str, run: TypstRun) -> None:
+    """Run typst, within the limits of `run`.
+
+    Raises `LimitExceeded` when typst runs out of time, or is killed by a
+    signal while its memory is limited.
+    """
+    metrics.count("typst_runs")
+    with metrics.timed("typst"):
+        try:
+            await _run_typst(name, run)
+        except Exception:
+            metrics.count("typst_failures")
+            raise
+
+
+async def _run_typst(name: str, run: TypstRun) -> None:
+    _logger.info("Running `%s`", " ".join(run.args))
+    budget = run.budget or limits.Limits()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *run.args,
+            cwd=run.cwd,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        _logger.error("Failed to call typst.  Ensure typst is installed")
+        raise
+    limits.limit_process(process.pid, budget)
+
+    try:
+        async with asyncio.timeout(budget.timeout):
+            async for line in process.stderr:
+                sys.stderr.write(f"[{name}] {line.decode(errors='replace')}")
+            returncode = await process.wait()
+    except TimeoutError:
+        await kill(process)
+        error = limits.timed_out("typst", budget)
+        raise error from None
+    except asyncio.CancelledError:
+        await kill(process)
+        raise
+    limits.check_signal("typst", returncode, budget)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, run.args)
+
+
+async def kill(process: asyncio.subprocess.Process) -> None:
+    process.kill()
+    await process.wait()
@@ -0,0 +1,209 @@
+"""Locate and read the files a note embeds before converting it.
+
+Conversion reads embedded notes and PDFs one after another, as it reaches
+them. On a vault served over the network, each of those reads waits on a
+round trip. Prefetching scans the note for embeds and links up front,
+locates them all at once, and reads them on a thread pool, so that the
+waits overlap. Embedded notes are scanned in turn, a level of embedding
+at a time. Embeds are only looked for where the converter would find them,
+outside frontmatter, comments and code blocks.
+
+Prefetching never fails a conversion. Files that can't be found or read
+are left for the converter, which reports them where they are used.
+"""
+
+import concurrent.futures
+import logging
+import re
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+from obsidian_to_typst import (
+    metrics,
+    obsidian_path,
+    prefilter,
+    process_markdown,
+)
+
+_logger = logging.getLogger(__name__)
+
+WORKERS = 16
+EMBED_REGEX = re.compile(r"^[ \t]*!\[\[.*]][ \t]*$", re.MULTILINE)
+LINK_REGEX = re.compile(r"(?<!!)\[\[(.+?)]]")
+LINK_NAME_REGEX = re.compile(r"([a-zA-Z0-9-_\s]+)")
+
+
+def prefetch(text: str) -> process_markdown.Prefetched:
+    """Locate and read what the markdown `text` embeds and links to.
+
+    Uses the current `process_markdown.OPTIONS` to decide how deeply to
+    follow embeds, how much embedded markdown to read, and what to read of
+    embedded PDFs.
+    """
+    prefetched = process_markdown.Prefetched()
+    located: set[str] = set()
+    embedded: set[str] = set()
+    texts = [text]
+    # Characters of embedded markdown left to read before conversion would
+    # stop at the limit anyway.
+    remaining = process_markdown.OPTIONS.max_embed_size
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=WORKERS, thread_name_prefix="prefetch"
+    ) as pool:
+        for _depth in range(process_markdown.OPTIONS.max_embed_depth + 1):
+            if remaining is not None and remaining < 0:
+                break
+            embeds, links = set(), set()
+            for t in texts:
+                embeds_of_t, links_of_t = targets(t)
+                embeds |= embeds_of_t - embedded
+                links |= links_of_t - located
+            if not embeds and not links:
+                break
+            found = obsidian_path.find_files((embeds | links) - located)
+            prefetched.paths.update(
+                (name, path) for name, path in found.items() if path
+            )
+            located |= found.keys()
+            embedded |= embeds
+            texts = fetch_level(
+                pool,
+                [prefetched.paths[n] for n in embeds if n in prefetched.paths],
+                prefetched,
+                remaining,
+            )
+            if remaining is not None:
+                remaining -= sum(len(t) for t in texts)
+    metrics.count("prefetched_files", len(prefetched.paths))
+    return prefetched
+
+
+def fetch_level(
+    pool: concurrent.futures.Executor,
+    embedded: list[Path],
+    prefetched: process_markdown.Prefetched,
+    remaining: int | None = None,
+) -> list[str]:
+    """Read the `embedded` notes and PDFs, returning the notes' text.
+
+    Linked notes only need locating; embedded ones are read as well. Notes
+    stop being read once they add up to more than `remaining` characters.
+    """
+    notes = read_notes(pool, by_suffix(embedded, ".md"), remaining)
+    prefetched.texts.update(notes)
+    pdfs = by_suffix(embedded, ".pdf")
+    if process_markdown.pdf_embed_mode() == "split":
+        splits = process_markdown.split_pdf_pages
+        prefetched.pdf_splits.update(fetch_all(pool, splits, pdfs))
+    else:
+        counts = process_markdown.read_pdf_page_count
+        prefetched.page_counts.update(fetch_all(pool, counts, pdfs))
+    return list(notes.values())
+
+
+def targets(text: str) -> tuple[set[str], set[str]]:
+    """The file names `text` embeds, and links to, as the converter finds them.
+
+    >>> embeds, links = targets(
+    ...     "![[Part]]\\n ![[chart.png|300]] \\n"
+    ...     "See [[Glossary|terms]], [[#Heading]] and ![[x]] inline.\\n"
+    ... )
+    >>> sorted(embeds), sorted(links)
+    (['Part.md', 'chart.png'], ['Glossary.md'])
+
+    >>> targets(
+    ...     "%%\\n![[Draft]]\\n%%\\n```\\n![[Example]]\\n```\\n"
+    ... )
+    (set(), set())
+    """
+    text = "\n".join(markdown_lines(text))
+    embeds = set()
+    if "![[" in text:
+        for m in EMBED_REGEX.finditer(text):
+            name = embed_target(m.group(0).strip())
+            if name is not None:
+                embeds.add(name)
+    links = set()
+    for m in LINK_REGEX.finditer(text):
+        name = LINK_NAME_REGEX.match(m.group(1))
+        if name is not None:
+            links.add(name.group(1) + ".md")
+    return embeds, links
+
+
+def markdown_lines(text: str) -> list[str]:
+    """The lines of `text` converted as markdown.
+
+    Frontmatter and comments are removed, and code blocks skipped, as the
+    converter does.
+    """
+    lines = prefilter.prefilter(text)[0].splitlines()
+    kept = []
+    index = 0
+    while index < len(lines):
+        if process_markdown.CODE_FENCE_REGEX.match(lines[index]):
+            end = process_markdown.find_closing_fence(lines, index)
+            if end is None:
+                # An unclosed code block runs to the end of the file.
+                break
+            index = end + 1
+            continue
+        kept.append(lines[index])
+        index += 1
+    return kept
+
+
+def embed_target(line: str) -> str | None:
+    if process_markdown.is_markdown(line):
+        m = re.match(process_markdown.EMBEDDED_MARKDOWN_REGEX, line)
+        return m.group(1) + ".md"
+    if process_markdown.is_image(line):
+        return re.match(process_markdown.EMBEDDED_IMAGE_REGEX, line).group(1)
+    return None
+
+
+def by_suffix(paths: Iterable[Path], suffix: str) -> list[Path]:
+    return [p for p in paths if p.suffix.lower() == suffix]
+
+
+def read_note(path: Path) -> str:
+    with path.open(encoding="UTF-8") as f:
+        return f.read()
+
+
+def read_notes(
+    pool: concurrent.futures.Executor,
+    paths: list[Path],
+    remaining: int | None,
+) -> dict[Path, str]:
+    """Read the notes at `paths` on `pool`, up to `remaining` characters."""
+    futures = {pool.submit(read_note, path): path for path in paths}
+    notes = {}
+    for future, path in futures.items():
+        if remaining is not None and remaining < 0:
+            future.cancel()
+            continue
+        try:
+            notes[path] = future.result()
+        except Exception as e:  # noqa: BLE001
+            _logger.debug("Failed to prefetch `%s`: %s", path, e)
+            continue
+        if remaining is not None:
+            remaining -= len(notes[path])
+    return notes
+
+
+def fetch_all(
+    pool: concurrent.futures.Executor,
+    fetch: Callable[[Path], object],
+    paths: list[Path],
+) -> dict[Path, object]:
+    """`fetch` each of `paths` on `pool`, leaving out any that fail."""
+    futures = {pool.submit(fetch, path): path for path in paths}
+    fetched = {}
+    for future, path in futures.items():
+        try:
+            fetched[path] = future.result()
+        except Exception as e:  # noqa: BLE001
+            _logger.debug("Failed to prefetch `%s`: %s", path, e)
+    return fetched
@@ -0,0 +1,103 @@
+"""Remove the parts of a note that Obsidian does not render.
+
+Frontmatter, `%% comments %%` and `<!-- HTML comments -->` are found in a
+single pass over the text, before the line by line conversion, so that
+large metadata blocks are skipped in bulk instead of being converted.
+"""
+
+import re
+
+FRONTMATTER_REGEX = re.compile(
+    r"---[ \t]*\n(.*?\n)?(?:---|\.\.\.)[ \t]*(?:\n|$)", re.DOTALL
+)
+QUOTES = ("'", '"')
+FRONTMATTER_KEY_REGEX = re.compile(r"([^\s:#][^:]*):(?:[ \t]+(.*))?$")
+COMMENT_REGEX = re.compile(
+    r"(?P<code>^[ \t]*```.*?^[ \t]*```|`[^`\n]*`)|%%.*?%%|<!--.*?-->",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+def prefilter(text: str) -> tuple[str, int]:
+    """`text` without frontmatter or comments, and its first line number.
+
+    Comments are replaced by the line breaks they span, so that the
+    remaining lines keep their line numbers.
+
+    >>> prefilter("---\\ntitle: A\\n---\\n# A\\n")
+    ('# A\\n', 4)
+    >>> prefilter(
+    ...     "a %%hidden%% b\\n%%\\nhidden\\n%%\\nc <!-- x -->\\n"
+    ... )
+    ('a  b\\n\\n\\n\\nc \\n', 1)
+    >>> prefilter("`%%code%%`\\n```\\n%%\\n```\\n")
+    ('`%%code%%`\\n```\\n%%\\n```\\n', 1)
+    """
+    _frontmatter, body, first_line = split_frontmatter(text)
+    return strip_comments(body), first_line
+
+
+def split_frontmatter(text: str) -> tuple[str | None, str, int]:
+    """The frontmatter of `text`, the rest of it, and that rest's first line.
+
+    >>> split_frontmatter("---\\na: 1\\n---\\nbody\\n")
+    ('a: 1\\n', 'body\\n', 4)
+    >>> split_frontmatter("---\\n---\\n")
+    ('', '', 3)
+    >>> split_frontmatter("body\\n---\\n")
+    (None, 'body\\n---\\n', 1)
+    """
+    if not text.startswith("---"):
+        return None, text, 1
+    m = FRONTMATTER_REGEX.match(text)
+    if not m:
+        return None, text, 1
+    return m.group(1) or "", text[m.end() :], m.group(0).count("\n") + 1
+
+
+def parse_frontmatter(text: str) -> dict[str, str]:
+    """The top level `key: value` pairs of the frontmatter of `text`.
+
+    Only plain values are parsed; nested values, such as lists, are left as
+    an empty string. Reading stops at the end of the frontmatter, so the
+    body is never scanned.
+
+    >>> parse_frontmatter(
+    ...     "---\\ntitle: 'My Note'\\ntags:\\n  - a\\n# comment\\n---\\nBody"
+    ... )
+    {'title': 'My Note', 'tags': ''}
+    >>> parse_frontmatter("# Heading\\n")
+    {}
+    """
+    frontmatter, _body, _first_line = split_frontmatter(text)
+    if frontmatter is None:
+        return {}
+    values = {}
+    for line in frontmatter.splitlines():
+        m = FRONTMATTER_KEY_REGEX.match(line)
+        if m:
+            values[m.group(1).strip()] = unquote((m.group(2) or "").strip())
+    return values
+
+
+def unquote(value: str) -> str:
+    """
+    >>> unquote('"a"'), unquote("'b'"), unquote("c")
+    ('a', 'b', 'c')
+    """
+    quoted = len(value) >= 2 and value[0] == value[-1]  # noqa: PLR2004
+    if quoted and value[0] in QUOTES:
+        return value[1:-1]
+    return value
+
+
+def strip_comments(text: str) -> str:
+    if "%%" not in text and "<!--" not in text:
+        return text
+    return COMMENT_REGEX.sub(keep_code, text)
+
+
+def keep_code(m: re.Match) -> str:
+    if m.group("code"):
+        return m.group(0)
+    return "\n" * m.group(0).count("\n")
@@ -0,0 +1,103 @@
+"""Pick out a single section of a note, for fast previews while editing."""
+
+import re
+
+from obsidian_to_typst import prefilter, process_markdown
+
+HEADING_REGEX = r"(#+)\s"
+LINK_LABEL_REGEX = r"#link\(<([^<>\s]+)>\)"
+LABEL_REGEX = r"(?<!\()<([^<>\s]+)>"
+
+
+def find_section(text: str, target: str) -> tuple[int, int]:
+    """Line range, [start, end), of the section of `text` named by `target`.
+
+    `target` is either a heading or a 1-based line number. A line number
+    picks the section the line is in. The section runs up to the next
+    heading at the same or a higher level.
+
+    >>> text = "# Doc\\n## A\\na\\n### A.1\\nb\\n## B\\nc\\n"
+    >>> find_section(text, "A")
+    (1, 5)
+    >>> find_section(text, "### A.1")
+    (3, 5)
+    >>> find_section(text, "7")
+    (5, 7)
+    >>> find_section(text, "Doc")
+    (0, 7)
+    >>> find_section("intro\\n## A\\n", "1")
+    (0, 1)
+    """
+    levels = heading_levels(text.splitlines())
+    if not levels:
+        return 0, len(text.splitlines())
+
+    if target.isdigit():
+        line = int(target) - 1
+        start = max((i for i in levels if i <= line), default=0)
+    else:
+        wanted = process_markdown.heading_ref_label(target.lstrip("#"))
+        lines = text.splitlines()
+        matches = [
+            i
+            for i in levels
+            if process_markdown.heading_ref_label(lines[i].lstrip("#"))
+            == wanted
+        ]
+        if not matches:
+            msg = f"No heading matches `{target}`"
+            raise ValueError(msg)
+        start = matches[0]
+
+    # Text before the first heading runs up to any heading.
+    level = levels.get(start)
+    end = min(
+        (
+            i
+            for i, lvl in levels.items()
+            if i > start and (level is None or lvl <= level)
+        ),
+        default=len(text.splitlines()),
+    )
+    return start, end
+
+
+def heading_levels(lines: list[str]) -> dict[int, int]:
+    """Map the index of each heading line to its level.
+
+    Lines in code blocks, or in frontmatter, are not headings.
+
+    >>> heading_levels(["---", "# not: a heading", "---", "## A"])
+    {3: 2}
+    """
+    levels = {}
+    in_code_block = False
+    _frontmatter, _body, first_line = prefilter.split_frontmatter(
+        "".join(line + "\n" for line in lines)
+    )
+    for i, line in enumerate(lines[first_line - 1 :], start=first_line - 1):
+        if process_markdown.CODE_FENCE_REGEX.match(line):
+            in_code_block = not in_code_block
+            continue
+        m = re.match(HEADING_REGEX, line)
+        if m and not in_code_block:
+            levels[i] = len(m.group(1))
+    return levels
+
+
+def extract_section(text: str, target: str) -> str:
+    start, end = find_section(text, target)
+    lines = text.splitlines()[start:end]
+    return "\n".join(lines) + "\n"
+
+
+def missing_label_stubs(typst: str) -> str:
+    """Labels for links whose targets lie outside of the previewed section.
+
+    >>> missing_label_stubs("#link(<a>)[A] #link(<b>)[B] <b>")
+    '\\n\\n.<a>'
+    """
+    linked = re.findall(LINK_LABEL_REGEX, typst)
+    defined = set(re.findall(LABEL_REGEX, typst))
+    missing = [label for label in dict.fromkeys(linked) if label not in defined]
+    return "".join(f"\n\n.<{label}>" for label in missing)
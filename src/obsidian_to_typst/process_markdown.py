@@ -1,19 +1,37 @@
+import contextlib
+import dataclasses
+import hashlib
 import logging
 import re
+import shutil
+import tempfile
 from pathlib import Path
+from typing import Literal
 
 import pydantic
 import pypdf
 from pydantic.dataclasses import dataclass
 
-from obsidian_to_typst import obsidian_path
+from obsidian_to_typst import cache_store, metrics, obsidian_path, prefilter
 
 _logger = logging.getLogger(__name__)
 
 referenced_docs = set()
 docs_embedded = set()
 
+EMBEDDED_MARKDOWN_REGEX = r"!\[\[(.*)]]"
 EMBEDDED_IMAGE_REGEX = r"!\[\[([\s_a-zA-Z0-9.-]*)\|?([0-9]+)?x?([0-9]+)?]]"
+CODE_FENCE_REGEX = re.compile(r"\s*```")
+HEADING_REGEX = re.compile(r"(#*)\s*(.*)")
+SECTION_DEPTHS = range(2, 7)
+TABLE_DELIMITER_REGEX = re.compile(
+    r"\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$"
+)
+# A pipe separates cells, unless it is escaped or inside a code span.
+CELL_SEPARATOR_REGEX = re.compile(r"(`[^`]*`|\\.)|\|")
+INLINE_MARKUP_REGEX = re.compile(r"[`*\[\]^\\!]")
+PDF_PAGES_FOLDER_NAME = "pdf-pages"
+PDF_PAGE_COUNT_NAMESPACE = "pdf-page-count"
 
 
 @dataclass
@@ -22,6 +40,38 @@ class Indent:
     depth: str
 
 
+@dataclass
+class Prefetched:
+    """Files located and read ahead of converting a document.
+
+    Filled in by `prefetch`, so that the converter rarely waits on the file
+    system. Anything missing is looked up as the converter reaches it.
+    """
+
+    paths: dict[str, Path] = dataclasses.field(default_factory=dict)
+    texts: dict[Path, str] = dataclasses.field(default_factory=dict)
+    page_counts: dict[Path, int] = dataclasses.field(default_factory=dict)
+    pdf_splits: dict[Path, tuple[Path, int]] = dataclasses.field(
+        default_factory=dict
+    )
+
+
+@dataclass
+class HeadingLabels:
+    """Labels of the headings of one file, worked out when it is entered.
+
+    Labels are unique across the document. A heading whose label is taken
+    already, by an earlier heading of the document or of an embedded note,
+    gets a numbered suffix.
+    """
+
+    # Labels of the headings with each text, in order.
+    by_text: dict[str, list[str]] = dataclasses.field(default_factory=dict)
+    # Where a `[[#heading]]` link in the file goes: the first heading of
+    # the file with that slug.
+    by_slug: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
 @dataclass
 class State:
     # pylint: disable=too-many-instance-attributes
@@ -34,6 +84,17 @@ class State:
     temp_dir: Path | None
     typst_block: int | None
     pending_file_label: str | None
+    side_file_count: int
+    embedded_size: int
+    dependencies: set[Path]
+    # Notes linked to, and the file each was first linked from. They are
+    # located together once the document is converted.
+    link_targets: dict[str, Path | None]
+    prefetched: Prefetched
+    # Heading labels of each file being converted, innermost last, and
+    # every heading label handed out in the document.
+    heading_labels: list[HeadingLabels]
+    used_labels: set[str]
 
     @classmethod
     def new(cls) -> "State":
@@ -47,9 +108,16 @@ def new(cls) -> "State":
             temp_dir=None,
             typst_block=None,
             pending_file_label=None,
+            side_file_count=0,
+            embedded_size=0,
+            dependencies=set(),
+            link_targets={},
+            prefetched=Prefetched(),
+            heading_labels=[],
+            used_labels=set(),
         )
 
-    def init(self, temp_dir: Path, file: Path) -> None:
+    def init(self, temp_dir: Path | None, file: Path) -> None:
         self.heading_depth = 0
         self.parent_heading_depth = 0
         self.code_block = None
@@ -59,24 +127,365 @@ def init(self, temp_dir: Path, file: Path) -> None:
         self.temp_dir = temp_dir
         self.typst_block = None
         self.pending_file_label = None
+        self.side_file_count = 0
+        self.embedded_size = 0
+        self.dependencies = set()
+        self.link_targets = {}
+        self.prefetched = Prefetched()
+        self.heading_labels = []
+        self.used_labels = set()
+
+
+@dataclass
+class Options:
+    # Code blocks with at least this many lines are written to a side file
+    # in the temp folder and loaded with typst's `read()`, which keeps the
+    # main document small.  `None` keeps every code block inline.
+    code_side_file_lines: int | None = None
+    # How multi-page PDFs are embedded: one `#image` call per page, a typst
+    # loop over the page count, or a loop over single-page PDFs split out
+    # once into the vault's cache folder.
+    pdf_embed: Literal["pages", "loop", "split"] = "pages"
+    # Limits on how deeply notes may be embedded in each other, and on the
+    # total number of characters of markdown embedded into one document.
+    max_embed_depth: int = 32
+    max_embed_size: int | None = None
+
+
+@dataclass
+class Frame:
+    """A file, or other markdown text, whose lines are being converted.
+
+    Embedded notes are converted by pushing a frame onto an explicit stack
+    instead of recursing, so deep chains of embeds don't use the Python
+    stack. An embedded frame remembers the state to restore once it's done.
+    """
+
+    lines: list[str]
+    output: list[str | None]
+    index: int = 0
+    # Line number of `lines[0]` in the file, after frontmatter is removed.
+    first_line: int = 1
+    file: Path | None = None
+    embedded: bool = False
+    parent_heading_depth: int = 0
+    pending_file_label: str | None = None
+    # Label of the embedded file itself, unique among those of the document.
+    label: str | None = None
+
+    def leave(self) -> None:
+        STATE.file.pop()
+        STATE.heading_labels.pop()
+        STATE.heading_depth = STATE.parent_heading_depth + 1
+        STATE.parent_heading_depth = self.parent_heading_depth
+        STATE.pending_file_label = self.pending_file_label
+
+
+class EmbedError(Exception):
+    pass
 
 
 STATE: State = State.new()
+OPTIONS: Options = Options()
 
 
 @pydantic.validate_call
-def init_state(temp_dir: Path, file: Path) -> None:
+def init_state(temp_dir: Path | None, file: Path) -> None:
     STATE.init(temp_dir, file)
+    referenced_docs.clear()
+    docs_embedded.clear()
+    obsidian_path.forget_missing()
 
 
 @pydantic.validate_call
 def obsidian_to_typst(input_text: str) -> str:
-    lines = input_text.splitlines()
-    lines = [_line_to_typst(i + 1, line) for i, line in enumerate(lines)]
-    lines = [line for line in lines if line is not None]
+    text, first_line = prefilter.prefilter(input_text)
+    lines = text.splitlines()
+    STATE.heading_labels.append(
+        register_headings(lines, STATE.parent_heading_depth)
+    )
+    try:
+        typst = expand(
+            Frame(
+                lines=lines,
+                output=[],
+                first_line=first_line,
+                file=STATE.file[-1] if STATE.file else None,
+            )
+        )
+    finally:
+        STATE.heading_labels.pop()
+    resolve_links()
+    return typst
+
+
+def resolve_links() -> None:
+    """Locate every note linked to, in one pass over the vault.
+
+    Labels of linked notes depend only on their names, so links are
+    converted without knowing where the notes are.
+    """
+    link_targets = STATE.link_targets
+    STATE.link_targets = {}
+    found = {name: STATE.prefetched.paths.get(name) for name in link_targets}
+    found.update(
+        obsidian_path.find_files(
+            name for name, path in found.items() if path is None
+        )
+    )
+    STATE.dependencies.update(path for path in found.values() if path)
+    missing = [
+        f"`{name}`, linked from `{link_targets[name]}`"
+        for name, path in found.items()
+        if path is None
+    ]
+    if missing:
+        msg = (
+            f"Unable to locate {'; '.join(missing)} under "
+            f"`{obsidian_path.VAULT_ROOT}`"
+        )
+        raise FileNotFoundError(msg)
+
+
+def expand(root: Frame) -> str:
+    stack = [root]
+    try:
+        while True:
+            frame = stack[-1]
+            if frame.index < len(frame.lines):
+                embedded_frame = convert_next_lines(frame)
+                if embedded_frame is not None:
+                    stack.append(embedded_frame)
+                continue
+            text = finish_frame(frame)
+            stack.pop()
+            if not stack:
+                return text
+            stack[-1].output.append(text)
+    except Exception:
+        for frame in reversed(stack[:-1]):
+            logging.getLogger(__name__).error(
+                "Failed to parse `%s:%s`",
+                frame.file,
+                frame.first_line + frame.index - 1,
+            )
+        for frame in reversed(stack):
+            if frame.embedded:
+                frame.leave()
+        raise
+
+
+def convert_next_lines(frame: Frame) -> Frame | None:
+    """Convert the next line, code block or table of `frame`.
+
+    Returns a new frame when the line embeds a markdown file, instead of
+    converting it.
+    """
+    start = frame.index
+    end = find_closing_fence(frame.lines, start)
+    if end is not None:
+        frame.output.extend(
+            code_block_to_typst(frame.lines, start, end, frame.first_line)
+        )
+        frame.index = end + 1
+        return None
+    end = find_table_end(frame.lines, start)
+    if end is not None:
+        frame.output.extend(table_to_typst(frame.lines, start, end))
+        frame.index = end
+        return None
+
+    line = frame.lines[start]
+    frame.index += 1
+    if (
+        not (STATE.code_block or STATE.mermaid_block)
+        and is_embedded(line)
+        and is_markdown(line.strip())
+    ):
+        try:
+            return enter_embedded_markdown(line.strip())
+        except Exception:
+            logging.getLogger(__name__).error(
+                "Failed to parse `%s:%s`",
+                STATE.file[-1],
+                frame.first_line + start,
+            )
+            raise
+    frame.output.append(_line_to_typst(frame.first_line + start, line))
+    return None
+
+
+def finish_frame(frame: Frame) -> str:
+    lines = [line for line in frame.output if line is not None]
     lines.append("")
-    text = "\n".join(lines)
-    return text + cleanup()
+    text = "\n".join(lines) + cleanup()
+    if not frame.embedded:
+        return text
+
+    label_was_consumed = STATE.pending_file_label is None
+    frame.leave()
+    docs_embedded.add(file_ref_label(frame.file))
+    if label_was_consumed:
+        return text
+    # No heading was found in the embedded file to carry the label, so fall
+    # back to a standalone label at the top of the embedded content.
+    return f"<{frame.label}>" + text
+
+
+def find_closing_fence(lines: list[str], start: int) -> int | None:
+    """Index of the fence closing a code block opened at `start`, if any.
+
+    Returns None when `lines[start]` does not open a code block, or when the
+    block is never closed, leaving it to the line by line conversion.
+    """
+    if STATE.code_block or STATE.mermaid_block:
+        return None
+    if not CODE_FENCE_REGEX.match(lines[start]):
+        return None
+    for end in range(start + 1, len(lines)):
+        if CODE_FENCE_REGEX.match(lines[end]):
+            return end
+    return None
+
+
+def code_block_to_typst(
+    lines: list[str], start: int, end: int, first_line: int = 1
+) -> list[str]:
+    # The contents of a code block are passed through untouched, so they are
+    # emitted as a single slice instead of being converted line by line.
+    body = lines[start + 1 : end]
+    if (
+        OPTIONS.code_side_file_lines is not None
+        and len(body) >= OPTIONS.code_side_file_lines
+        and STATE.temp_dir is not None
+        and lines[start][3:] not in ("mermaid", "typst")
+    ):
+        return [code_block_side_file(lines[start], body)]
+
+    opening = toggle_code_block(first_line + start, lines[start])
+    if STATE.mermaid_block:
+        STATE.code_buffer += "".join(line + "\n" for line in body)
+        return [opening, toggle_code_block(first_line + end, lines[end])]
+    block = [opening]
+    if body:
+        block.append("\n".join(body))
+    block.append(toggle_code_block(first_line + end, lines[end]))
+    return block
+
+
+def code_block_side_file(fence: str, body: list[str]) -> str:
+    STATE.side_file_count += 1
+    side_file = (
+        STATE.temp_dir
+        / f"{STATE.file[0].stem}-code-{STATE.side_file_count}.txt"
+    )
+    with side_file.open("w", encoding="UTF-8") as f:
+        f.write("\n".join(body))
+
+    lang = fence[3:]
+    lang_text = f'"{escape_typst_string(lang)}"' if lang else "none"
+    source = f'read("{escape_typst_string(side_file.name)}")'
+    lines = [
+        R"",
+        R"#block(",
+        "fill: luma(230),",
+        "inset: 8pt,",
+        "radius: 2pt,",
+        "stroke: black,",
+        f"raw({source}, block: true, lang: {lang_text}),",
+        ")",
+    ]
+    return "\n".join(lines)
+
+
+def find_table_end(lines: list[str], start: int) -> int | None:
+    """Index of the line after a pipe table starting at `start`, if any.
+
+    A table is a header row, a delimiter row with as many cells, such as
+    `| --- | :-: |`, and every following line containing a `|`.
+    """
+    if STATE.code_block or STATE.mermaid_block:
+        return None
+    if start + 1 >= len(lines) or "|" not in lines[start + 1]:
+        return None
+    if not TABLE_DELIMITER_REGEX.match(lines[start + 1]):
+        return None
+    if len(split_cells(lines[start])) != len(split_cells(lines[start + 1])):
+        return None
+    end = start + 2
+    while end < len(lines) and "|" in lines[end] and lines[end].strip():
+        end += 1
+    return end
+
+
+def table_to_typst(lines: list[str], start: int, end: int) -> list[str]:
+    # Rows are emitted as separate lines of output, rather than as a single
+    # string, so tables of thousands of rows are only joined once, with the
+    # rest of the document.
+    header = split_cells(lines[start])
+    columns = len(header)
+    table = ["#table(", f"columns: {columns},"]
+    aligns = [cell_alignment(cell) for cell in split_cells(lines[start + 1])]
+    if any(align != "auto" for align in aligns):
+        table.append(f"align: ({', '.join(aligns)},),")
+    table.append(f"table.header({table_cells(header, columns)}),")
+    table.extend(
+        f"{table_cells(split_cells(row), columns)},"
+        for row in lines[start + 2 : end]
+    )
+    table.append(")")
+    return table
+
+
+def split_cells(row: str) -> list[str]:
+    r"""
+    >>> split_cells("| a | `b` | c \\| d |")
+    ['a', '`b`', 'c \\| d']
+    >>> split_cells("a|b")
+    ['a', 'b']
+    >>> split_cells("| *i* | `c|d` |")
+    ['*i*', '`c|d`']
+    """
+    row = row.strip()
+    row = row.removeprefix("|")
+    if row.endswith("|") and not row.endswith("\\|"):
+        row = row[:-1]
+    cells = []
+    start = 0
+    for m in CELL_SEPARATOR_REGEX.finditer(row):
+        if m.group(1) is None:
+            cells.append(row[start : m.start()])
+            start = m.end()
+    cells.append(row[start:])
+    return [cell.strip() for cell in cells]
+
+
+def cell_alignment(delimiter: str) -> str:
+    """
+    >>> [cell_alignment(d) for d in ["---", ":--", "--:", ":-:"]]
+    ['auto', 'left', 'right', 'center']
+    """
+    if delimiter.startswith(":") and delimiter.endswith(":"):
+        return "center"
+    if delimiter.startswith(":"):
+        return "left"
+    if delimiter.endswith(":"):
+        return "right"
+    return "auto"
+
+
+def table_cells(cells: list[str], columns: int) -> str:
+    # Rows with missing cells are padded, and extra cells are dropped.
+    cells = [*cells[:columns], *[""] * (columns - len(cells))]
+    return ", ".join(f"[{cell_to_typst(cell)}]" for cell in cells)
+
+
+def cell_to_typst(cell: str) -> str:
+    # Most cells of generated tables are plain numbers and names, which only
+    # need escaping, so skip the character by character conversion.
+    if INLINE_MARKUP_REGEX.search(cell):
+        return string_to_typst(cell)
+    return sanitize_special_characters(cell)
 
 
 @pydantic.validate_call
@@ -117,17 +526,10 @@ def line_to_typst(
 @pydantic.validate_call
 def line_to_section(line: str) -> str:
     assert line.startswith("#"), line
-    section_lookup = {
-        2: "=",
-        3: "==",
-        4: "===",
-        5: "====",
-        6: "=====",
-    }
-    s, line = re.match(r"(#*)\s*(.*)", line).groups()
+    s, line = HEADING_REGEX.match(line).groups()
     STATE.heading_depth = len(s) + STATE.parent_heading_depth
 
-    if STATE.heading_depth not in section_lookup:
+    if STATE.heading_depth not in SECTION_DEPTHS:
         return line + "\n\n"
 
     # Typst only allows a single label per element, so if this heading is
@@ -136,11 +538,12 @@ def line_to_section(line: str) -> str:
     # before an element in Typst attaches to whatever precedes it, not to
     # the element that follows, so the file label has to live here instead
     # of before the heading.)
+    label = take_heading_label(line)
     if STATE.pending_file_label:
         label = STATE.pending_file_label
         STATE.pending_file_label = None
-    else:
-        label = heading_ref_label(line)
+    elif label is None:
+        label = unique_label(heading_ref_label(line), STATE.used_labels)
     line = string_to_typst(line)
     return f"#heading(level:{STATE.heading_depth - 1})[{line}] <{label}>"
 
@@ -164,44 +567,87 @@ def embed_file(line: str) -> str:
 
 @pydantic.validate_call
 def is_markdown(line: str) -> bool:
-    m = re.match(r"!\[\[(.*)]]", line)
+    m = re.match(EMBEDDED_MARKDOWN_REGEX, line)
     file_name = m.group(1)
     return Path(file_name).suffix == ""
 
 
 @pydantic.validate_call
 def embed_markdown(embed_line: str) -> str:
-    m = re.match(r"!\[\[(.*)]]", embed_line)
+    return expand(enter_embedded_markdown(embed_line))
+
+
+@pydantic.validate_call
+def enter_embedded_markdown(embed_line: str) -> Frame:
+    m = re.match(EMBEDDED_MARKDOWN_REGEX, embed_line)
     file_name = m.group(1)
     assert is_markdown(embed_line), embed_line
 
     file_name = file_name + ".md"
-    file = obsidian_path.find_file(file_name)
-
-    with file.open(encoding="UTF-8") as f:
-        text = f.read()
-
+    file = locate(file_name)
+    check_embed_allowed(file)
+    STATE.dependencies.add(file)
+
+    text = STATE.prefetched.texts.get(file)
+    if text is None:
+        with file.open(encoding="UTF-8") as f:
+            text = f.read()
+    STATE.embedded_size += len(text)
+    metrics.count("embedded_notes")
+    metrics.count("embedded_markdown_bytes", len(text.encode("UTF-8")))
+    if (
+        OPTIONS.max_embed_size is not None
+        and STATE.embedded_size > OPTIONS.max_embed_size
+    ):
+        msg = (
+            f"Embedding `{file}` takes the embedded markdown past the limit "
+            f"of {OPTIONS.max_embed_size} characters"
+        )
+        raise EmbedError(msg)
+
+    text, first_line = prefilter.prefilter(text)
+    frame = Frame(
+        lines=text.splitlines(),
+        output=[],
+        first_line=first_line,
+        file=file,
+        embedded=True,
+        parent_heading_depth=STATE.parent_heading_depth,
+        pending_file_label=STATE.pending_file_label,
+        # Links go to the first embed of a file, which keeps the plain label.
+        label=unique_label(file_ref_label(file), STATE.used_labels),
+    )
     STATE.file.append(file)
-    current_parent_depth = STATE.parent_heading_depth
     STATE.parent_heading_depth = STATE.heading_depth - 1
-    ref_label = file_ref_label(file)
-    current_pending_label = STATE.pending_file_label
-    STATE.pending_file_label = ref_label
-    try:
-        result = obsidian_to_typst(text)
-    finally:
-        STATE.file.pop()
-        STATE.heading_depth = STATE.parent_heading_depth + 1
-        STATE.parent_heading_depth = current_parent_depth
-        label_was_consumed = STATE.pending_file_label is None
-        STATE.pending_file_label = current_pending_label
+    STATE.pending_file_label = frame.label
+    STATE.heading_labels.append(
+        register_headings(
+            frame.lines, STATE.parent_heading_depth, STATE.pending_file_label
+        )
+    )
+    return frame
 
-    docs_embedded.add(ref_label)
-    if label_was_consumed:
-        return result
-    # No heading was found in the embedded file to carry the label, so fall
-    # back to a standalone label at the top of the embedded content.
-    return file_label(file) + result
+
+def locate(file_name: str) -> Path:
+    """Find `file_name` in the vault, or among the prefetched files."""
+    path = STATE.prefetched.paths.get(file_name)
+    return obsidian_path.find_file(file_name) if path is None else path
+
+
+@pydantic.validate_call
+def check_embed_allowed(file: Path) -> None:
+    chain = [*STATE.file, file]
+    if file in STATE.file:
+        msg = "Embedded notes form a cycle: " + " -> ".join(
+            f"`{f}`" for f in chain
+        )
+        raise EmbedError(msg)
+    if len(STATE.file) > OPTIONS.max_embed_depth:
+        msg = (
+            f"Embedded notes are nested more than {OPTIONS.max_embed_depth} "
+            "deep: " + " -> ".join(f"`{f}`" for f in chain)
+        )
+        raise EmbedError(msg)
 
 
 @pydantic.validate_call
@@ -226,7 +672,7 @@ def embed_image(line: str) -> str:
     assert m, f"{line}"
     file_name, width, height = m.groups()
     return include_image(
-        obsidian_path.find_file(file_name),
+        locate(file_name),
         width,
         height,
     )
@@ -236,18 +682,27 @@ def embed_image(line: str) -> str:
 def include_image(
     image_path: Path, width: int | None, height: int | None
 ) -> str:
+    STATE.dependencies.add(image_path)
     width_text = R"80%" if width is None else f"{int(width / 2)}pt"
     height_text = "" if height is None else f"height:{int(height / 2)}pt,"
 
     if image_path.suffix.lower() == ".pdf":
+        metrics.count("pdfs")
         return include_pdf(image_path, width_text, height_text)
 
+    metrics.count("images")
     root_relative_path = obsidian_path.root_path(image_path)
     return f'#image("{root_relative_path}",width:{width_text},{height_text})'
 
 
 @pydantic.validate_call
 def include_pdf(image_path: Path, width_text: str, height_text: str) -> str:
+    mode = pdf_embed_mode()
+    if mode == "loop":
+        return include_pdf_loop(image_path, width_text, height_text)
+    if mode == "split":
+        return include_pdf_split(image_path, width_text, height_text)
+
     # Typst's #image only renders a single page of a PDF (page 1 by
     # default), which silently drops the rest of a multi-page report.
     # Render every page as its own image, separated by page breaks, so
@@ -262,9 +717,120 @@ def include_pdf(image_path: Path, width_text: str, height_text: str) -> str:
     return "\n#pagebreak()\n".join(pages)
 
 
+def pdf_embed_mode() -> str:
+    """`OPTIONS.pdf_embed`, unless it can't be used in this run.
+
+    Split pages are written to the vault's cache, so runs that must write
+    nothing, such as those to stdout, loop over the PDF's pages instead.
+    """
+    if OPTIONS.pdf_embed == "split" and cache_store.READ_ONLY:
+        return "loop"
+    return OPTIONS.pdf_embed
+
+
+@pydantic.validate_call
+def include_pdf_loop(
+    image_path: Path, width_text: str, height_text: str
+) -> str:
+    root_relative_path = obsidian_path.root_path(image_path)
+    page_count = pdf_page_count(image_path)
+    return pdf_page_loop(
+        page_count,
+        f'image("{root_relative_path}",width:{width_text},'
+        f"{height_text}page:page)",
+    )
+
+
+@pydantic.validate_call
+def include_pdf_split(
+    image_path: Path, width_text: str, height_text: str
+) -> str:
+    split = STATE.prefetched.pdf_splits.get(image_path)
+    pages_dir, page_count = split or split_pdf_pages(image_path)
+    root_relative_dir = obsidian_path.root_path(pages_dir)
+    return pdf_page_loop(
+        page_count,
+        f'image("{root_relative_dir}/" + str(page) + ".pdf",'
+        f"width:{width_text},{height_text})",
+    )
+
+
+@pydantic.validate_call
+def pdf_page_loop(page_count: int, image_call: str) -> str:
+    """
+    >>> print(pdf_page_loop(3, 'image("/a.pdf",page:page)'))
+    #for page in range(1, 4) {
+    if page > 1 { pagebreak() }
+    image("/a.pdf",page:page)
+    }
+    """
+    lines = [
+        f"#for page in range(1, {page_count + 1}) {{",
+        "if page > 1 { pagebreak() }",
+        image_call,
+        "}",
+    ]
+    return "\n".join(lines)
+
+
+@pydantic.validate_call
+def split_pdf_pages(pdf_path: Path) -> tuple[Path, int]:
+    """Split `pdf_path` into one file per page under the vault's cache.
+
+    Pages are keyed on a hash of the PDF's contents, so they are only split
+    again when the PDF changes. Returns the folder of pages and the page
+    count.
+    """
+    with pdf_path.open("rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    pages_root = obsidian_path.cache_dir() / PDF_PAGES_FOLDER_NAME
+    pages_dir = pages_root / digest
+    if pages_dir.is_dir():
+        return pages_dir, len(list(pages_dir.glob("*.pdf")))
+
+    # Split into a scratch folder and rename it into place, so that
+    # concurrent conversions never see a partially split PDF.
+    pages_root.mkdir(parents=True, exist_ok=True)
+    scratch_dir = Path(tempfile.mkdtemp(dir=pages_root, prefix=".split-"))
+    try:
+        reader = pypdf.PdfReader(pdf_path)
+        for page_number, page in enumerate(reader.pages, start=1):
+            writer = pypdf.PdfWriter()
+            writer.add_page(page)
+            with (scratch_dir / f"{page_number}.pdf").open("wb") as f:
+                writer.write(f)
+        # Fails when another process finished splitting the same PDF first.
+        with contextlib.suppress(OSError):
+            scratch_dir.rename(pages_dir)
+    finally:
+        # Left behind when the split failed part way, or lost the race.
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return pages_dir, len(reader.pages)
+
+
 @pydantic.validate_call
 def pdf_page_count(pdf_path: Path) -> int:
-    return len(pypdf.PdfReader(pdf_path).pages)
+    page_count = STATE.prefetched.page_counts.get(pdf_path)
+    if page_count is None:
+        page_count = read_pdf_page_count(pdf_path)
+    metrics.count("pdf_pages", page_count)
+    return page_count
+
+
+def read_pdf_page_count(pdf_path: Path) -> int:
+    # Hashing a PDF is much quicker than parsing it.
+    vault_root = obsidian_path.VAULT_ROOT
+    key = obsidian_path.root_path(pdf_path)
+    digest = cache_store.content_hash(pdf_path)
+    page_count = cache_store.get(
+        vault_root, PDF_PAGE_COUNT_NAMESPACE, key, digest
+    )
+    if page_count is None:
+        page_count = len(pypdf.PdfReader(pdf_path).pages)
+        cache_store.put(
+            vault_root, PDF_PAGE_COUNT_NAMESPACE, key, page_count, digest
+        )
+    return page_count
 
 
 @pydantic.validate_call
@@ -334,6 +900,11 @@ def mermaid_block_to_typst() -> str:
 
 @pydantic.validate_call
 def escape_mermaid_source(text: str) -> str:
+    return escape_typst_string(text)
+
+
+@pydantic.validate_call
+def escape_typst_string(text: str) -> str:
     return text.replace("\\", "\\\\").replace('"', '\\"')
 
 
@@ -376,6 +947,10 @@ def string_to_typst(unprocessed_text: str) -> str:
             elif char == "[":
                 pt, unprocessed_text = split_link(unprocessed_text)
                 processed_text += pt
+            elif char == "]":
+                # Unescaped, it would close the content block, such as a
+                # heading or table cell, that the text ends up in.
+                processed_text += R"\]"
             elif char == "^":
                 pt, unprocessed_text = split_reference(unprocessed_text)
                 processed_text += pt
@@ -400,8 +975,12 @@ def string_to_typst(unprocessed_text: str) -> str:
 
 @pydantic.validate_call
 def split_verbatim(text: str) -> tuple[str, str]:
+    m = re.match(r"(.*?`)(.*)", text)
+    if m is None:
+        # An unmatched backtick is just a backtick.
+        return R"\`", text
     processed_text = R"`"
-    verb_text, unprocessed_text = re.match(r"(.*?`)(.*)", text).groups()
+    verb_text, unprocessed_text = m.groups()
     processed_text += verb_text
     return processed_text, unprocessed_text
 
@@ -471,7 +1050,11 @@ def split_document_link(text: str) -> tuple[str, str] | None:
         return None
     doc_name, disp_text = m.groups()
 
-    doc_ref = file_ref_label(obsidian_path.find_file(doc_name + ".md"))
+    doc_file_name = doc_name + ".md"
+    STATE.link_targets.setdefault(
+        doc_file_name, STATE.file[-1] if STATE.file else None
+    )
+    doc_ref = file_ref_label(Path(doc_file_name))
     referenced_docs.add(doc_ref)
     disp_text = (
         sanitize_special_characters(disp_text) if disp_text else doc_name
@@ -527,6 +1110,84 @@ def heading_ref_label(heading_text: str) -> str:
     return f"heading-{slug}"
 
 
+def register_headings(
+    lines: list[str], parent_heading_depth: int, file_label: str | None = None
+) -> HeadingLabels:
+    """Work out the labels of the headings among `lines`, in order.
+
+    Lines are skipped as the conversion skips them: headings are only found
+    outside code blocks and tables. The first heading takes `file_label`,
+    when there is one, instead of a label of its own.
+    """
+    labels = HeadingLabels()
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if CODE_FENCE_REGEX.match(line):
+            end = find_closing_fence(lines, index)
+            if end is None:
+                # An unclosed code block runs to the end of the file.
+                break
+            index = end + 1
+            continue
+        end = find_table_end(lines, index)
+        if end is not None:
+            index = end
+            continue
+        index += 1
+        if not line.startswith("#"):
+            continue
+        hashes, text = HEADING_REGEX.match(line).groups()
+        if len(hashes) + parent_heading_depth not in SECTION_DEPTHS:
+            continue
+        slug = heading_ref_label(text)
+        if file_label:
+            label, file_label = file_label, None
+        else:
+            label = unique_label(slug, STATE.used_labels)
+        labels.by_text.setdefault(text, []).append(label)
+        labels.by_slug.setdefault(slug, label)
+    return labels
+
+
+def unique_label(label: str, used: set[str]) -> str:
+    """`label`, or it with the first free numbered suffix, added to `used`.
+
+    >>> used = set()
+    >>> [
+    ...     unique_label(label, used)
+    ...     for label in ["a", "a", "a-1", "a"]
+    ... ]
+    ['a', 'a-1', 'a-1-1', 'a-2']
+    """
+    unique, suffix = label, 0
+    while unique in used:
+        suffix += 1
+        unique = f"{label}-{suffix}"
+    used.add(unique)
+    return unique
+
+
+def take_heading_label(text: str) -> str | None:
+    """The label worked out for the next heading of this file with `text`."""
+    if not STATE.heading_labels:
+        return None
+    labels = STATE.heading_labels[-1].by_text.get(text)
+    return labels.pop(0) if labels else None
+
+
+def heading_link_label(heading_name: str) -> str:
+    """The label of the heading a `[[#heading_name]]` link goes to.
+
+    Links go to the first heading of that name in the file they're in.
+    Headings elsewhere in the document keep the label they'd have alone.
+    """
+    slug = heading_ref_label(heading_name)
+    if not STATE.heading_labels:
+        return slug
+    return STATE.heading_labels[-1].by_slug.get(slug, slug)
+
+
 @pydantic.validate_call
 def split_heading_link(text: str) -> tuple[str, str] | None:
     """
@@ -550,7 +1211,7 @@ def split_heading_link(text: str) -> tuple[str, str] | None:
     if not m:
         return None
     heading_name, disp_text, unprocessed_text = m.groups()
-    label = heading_ref_label(heading_name)
+    label = heading_link_label(heading_name)
     disp_text = (
         sanitize_special_characters(disp_text) if disp_text else heading_name
     )
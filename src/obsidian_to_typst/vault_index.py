@@ -0,0 +1,147 @@
+"""Compact index of the files in a vault, by name.
+
+Resident processes keep an index of every file in the vault, which for a
+vault of a few hundred thousand files is too large to hold as `Path`
+objects in a dict. Instead, each directory is stored once, and each file as
+a few integers in flat arrays:
+
+- the index of its directory,
+- the offset of its UTF-8 encoded name in a shared byte string,
+- a slot in an open addressing hash table of names.
+
+`Path` objects are only created for the files that are looked up.
+"""
+
+import array
+import os
+import sys
+from collections.abc import Iterable
+from pathlib import Path
+
+# Keep the hash table at most half full, so probe sequences stay short.
+MIN_SLOTS_PER_FILE = 2
+EMPTY = -1
+
+Walk = Iterable[tuple[str, list[str], list[str]]]
+
+
+class VaultIndex:
+    """Where the first file with each name lies under `root`.
+
+    Files are ordered as `os.walk` visits them, so that, as with a plain
+    walk, the first file found with a name wins.
+
+    >>> index = VaultIndex.from_walk(
+    ...     Path("/v"),
+    ...     [
+    ...         ("/v", ["a"], ["Doc.md"]),
+    ...         ("/v/a", [], ["Note.md", "Doc.md"]),
+    ...     ],
+    ... )
+    >>> index.find("Note.md").as_posix()
+    '/v/a/Note.md'
+    >>> index.find("Doc.md").as_posix()
+    '/v/Doc.md'
+    >>> index.find("Missing.md") is None
+    True
+    >>> len(index)
+    3
+    """
+
+    __slots__ = (
+        "_dir_ids",
+        "_directories",
+        "_names",
+        "_offsets",
+        "_slots",
+        "root",
+    )
+
+    def __init__(
+        self,
+        root: Path,
+        directories: list[str],
+        dir_ids: array.array,
+        names: bytes,
+        offsets: array.array,
+    ) -> None:
+        self.root = root
+        self._directories = directories
+        self._dir_ids = dir_ids
+        self._names = names
+        self._offsets = offsets
+        size = 8
+        while size < MIN_SLOTS_PER_FILE * len(dir_ids):
+            size *= 2
+        self._slots = array.array("i", [EMPTY]) * size
+        for file_id in range(len(dir_ids)):
+            slot = self._probe(self._name(file_id))
+            if self._slots[slot] == EMPTY:
+                self._slots[slot] = file_id
+
+    @classmethod
+    def build(cls, root: Path, skip_dirs: Iterable[str] = ()) -> "VaultIndex":
+        """Index the files under `root`, skipping directories in `skip_dirs`."""
+        skip_dirs = set(skip_dirs)
+
+        def walk() -> Walk:
+            for dir_path, dirs, files in os.walk(root):
+                dirs[:] = [d for d in dirs if d not in skip_dirs]
+                yield dir_path, dirs, files
+
+        return cls.from_walk(root, walk())
+
+    @classmethod
+    def from_walk(cls, root: Path, walk: Walk) -> "VaultIndex":
+        """Index the files listed by `walk`, in the form `os.walk` yields."""
+        root_text = str(root)
+        directories = []
+        dir_ids = array.array("I")
+        names = bytearray()
+        offsets = array.array("I", [0])
+        for dir_path, _dirs, files in walk:
+            if not files:
+                continue
+            relative = os.path.relpath(dir_path, root_text)
+            dir_id = len(directories)
+            directories.append(sys.intern("" if relative == "." else relative))
+            for file_name in files:
+                dir_ids.append(dir_id)
+                names += file_name.encode("UTF-8", "surrogateescape")
+                offsets.append(len(names))
+        return cls(root, directories, dir_ids, bytes(names), offsets)
+
+    def __len__(self) -> int:
+        return len(self._dir_ids)
+
+    def find(self, file_name: str) -> Path | None:
+        file_id = self._slots[
+            self._probe(file_name.encode("UTF-8", "surrogateescape"))
+        ]
+        if file_id == EMPTY:
+            return None
+        directory = self._directories[self._dir_ids[file_id]]
+        return self.root / directory / file_name
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the index."""
+        arrays = [self._dir_ids, self._offsets, self._slots]
+        return (
+            sys.getsizeof(self._names)
+            + sum(sys.getsizeof(a) for a in arrays)
+            + sys.getsizeof(self._directories)
+            + sum(sys.getsizeof(d) for d in self._directories)
+        )
+
+    def _name(self, file_id: int) -> bytes:
+        return self._names[self._offsets[file_id] : self._offsets[file_id + 1]]
+
+    def _probe(self, name: bytes) -> int:
+        """The slot holding `name`, or the empty slot it would go in."""
+        mask = len(self._slots) - 1
+        slot = hash(name) & mask
+        while True:
+            file_id = self._slots[slot]
+            if file_id == EMPTY or self._name(file_id) == name:
+                return slot
+            slot = (slot + 1) & mask
@@ -0,0 +1,161 @@
+import itertools
+import multiprocessing
+import os
+from pathlib import Path
+
+import pypdf
+import pytest
+from click.testing import CliRunner
+
+from obsidian_to_typst import (
+    cache_store,
+    obsidian_path,
+    obsidian_to_typst,
+    process_markdown,
+)
+
+
+@pytest.fixture
+def vault(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    (tmp_path / ".obsidian").mkdir()
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    cache_store.close()
+    obsidian_path.VAULT_ROOT = None
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> None:
+    ticks = itertools.count(start=1000, step=1000)
+    monkeypatch.setattr(cache_store.time, "time", lambda: float(next(ticks)))
+
+
+def test_get_returns_put_value(vault: Path) -> None:
+    cache_store.put(vault, "ns", "key", {"a": [1, 2]})
+
+    assert cache_store.get(vault, "ns", "key") == {"a": [1, 2]}
+    assert cache_store.get(vault, "other", "key") is None
+
+
+def test_get_ignores_entries_with_other_validator(vault: Path) -> None:
+    cache_store.put(vault, "ns", "key", 1, validator="old")
+
+    assert cache_store.get(vault, "ns", "key", validator="new") is None
+    assert cache_store.get(vault, "ns", "key", validator="old") == 1
+
+
+def test_get_creates_nothing(vault: Path) -> None:
+    assert cache_store.get(vault, "ns", "key") is None
+    assert not cache_store.cache_path(vault).exists()
+
+
+def test_read_only_writes_nothing(
+    vault: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(cache_store, "READ_ONLY", True)
+
+    cache_store.put(vault, "ns", "key", 1)
+
+    assert not cache_store.cache_path(vault).exists()
+
+
+@pytest.mark.usefixtures("clock")
+def test_evicts_least_recently_used(
+    vault: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(cache_store, "MAX_BYTES", 100)
+    value = "x" * 30
+    cache_store.put(vault, "ns", "a", value)
+    cache_store.put(vault, "ns", "b", value)
+    cache_store.get(vault, "ns", "a")
+
+    cache_store.put(vault, "ns", "c", value)
+
+    assert cache_store.get(vault, "ns", "a") == value
+    assert cache_store.get(vault, "ns", "b") is None
+    assert cache_store.get(vault, "ns", "c") == value
+
+
+def test_stats_and_clear_namespace(vault: Path) -> None:
+    cache_store.put(vault, "a", "1", "x")
+    cache_store.put(vault, "a", "2", "x")
+    cache_store.put(vault, "b", "1", "x")
+
+    assert cache_store.clear(vault, "a") == 2  # noqa: PLR2004
+    assert [s.namespace for s in cache_store.stats(vault)] == ["b"]
+
+
+def put_many(vault: Path, worker: int) -> None:
+    for i in range(50):
+        cache_store.put(vault, "ns", f"{worker}-{i}", i)
+
+
+def test_concurrent_processes(vault: Path) -> None:
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=put_many, args=(vault, worker))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [p.exitcode for p in processes] == [0, 0, 0, 0]
+    assert cache_store.stats(vault)[0].entries == 200  # noqa: PLR2004
+
+
+def test_pdf_page_count_is_cached(vault: Path) -> None:
+    obsidian_path.VAULT_ROOT = vault
+    pdf = vault / "doc.pdf"
+    writer = pypdf.PdfWriter()
+    writer.add_blank_page(width=72, height=72)
+    writer.add_blank_page(width=72, height=72)
+    with pdf.open("wb") as f:
+        writer.write(f)
+
+    assert process_markdown.pdf_page_count(pdf) == 2  # noqa: PLR2004
+    assert (
+        cache_store.get(
+            vault,
+            process_markdown.PDF_PAGE_COUNT_NAMESPACE,
+            "/doc.pdf",
+            cache_store.content_hash(pdf),
+        )
+        == 2  # noqa: PLR2004
+    )
+
+
+def test_cache_commands(vault: Path) -> None:
+    cache_store.put(vault, "ns", "key", 1)
+
+    result = CliRunner().invoke(obsidian_to_typst.main, ["cache", "stats"])
+    assert result.exit_code == 0, result.output
+    assert "ns: 1 entries" in result.stdout
+
+    result = CliRunner().invoke(obsidian_to_typst.main, ["cache", "clear"])
+    assert result.exit_code == 0, result.output
+    assert result.stdout == "Removed 1 entries\n"
+    assert cache_store.stats(vault) == []
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "geteuid") or os.geteuid() == 0,
+    reason="needs permissions to be enforced",
+)
+def test_put_ignores_an_unwritable_vault(vault: Path) -> None:
+    vault.chmod(0o555)
+    try:
+        cache_store.put(vault, "ns", "key", 1)
+    finally:
+        vault.chmod(0o755)
+
+    assert cache_store.get(vault, "ns", "key") is None
+
+
+def test_put_ignores_a_cache_folder_it_cannot_create(vault: Path) -> None:
+    (vault / obsidian_path.CACHE_FOLDER_NAME).touch()
+
+    cache_store.put(vault, "ns", "key", 1)
+
+    assert cache_store.get(vault, "ns", "key") is None
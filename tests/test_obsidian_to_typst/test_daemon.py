@@ -0,0 +1,123 @@
+import os
+import stat
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from obsidian_to_typst import daemon, obsidian_to_typst
+
+
+@pytest.fixture
+def vault(tmp_path: Path) -> Path:
+    (tmp_path / ".obsidian").mkdir()
+    (tmp_path / "Note.md").write_text(
+        "# Note\n\nHello, World!\n", encoding="UTF-8"
+    )
+    return tmp_path
+
+
+@pytest.fixture
+def address(tmp_path: Path) -> Iterator[str]:
+    socket_path = str(tmp_path / "daemon.sock")
+    server = daemon.make_server(socket_path, obsidian_to_typst.handle_request)
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True
+    )
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    server.server_close()
+
+
+def test_request_without_daemon_returns_none(tmp_path: Path) -> None:
+    assert daemon.request(str(tmp_path / "missing.sock"), {}) is None
+
+
+def test_ping(address: str) -> None:
+    assert daemon.request(address, {"command": "ping"}) == {"ok": True}
+
+
+def test_convert_returns_typst(address: str, vault: Path) -> None:
+    response = daemon.request(
+        address, {"command": "convert", "path": str(vault / "Note.md")}
+    )
+
+    assert response["ok"], response
+    assert "#set document(title:[Note], date:auto)" in response["typst"]
+    assert "Hello, World!" in response["typst"]
+
+
+def test_concurrent_converts(address: str, vault: Path) -> None:
+    for i in range(4):
+        (vault / f"Note{i}.md").write_text(f"# Note {i}\n", encoding="UTF-8")
+    results = {}
+
+    def convert(i: int) -> None:
+        results[i] = daemon.request(
+            address, {"command": "convert", "path": str(vault / f"Note{i}.md")}
+        )
+
+    threads = [threading.Thread(target=convert, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i in range(4):
+        assert results[i]["ok"], results[i]
+        assert f"title:[Note {i}]" in results[i]["typst"]
+
+
+def test_errors_are_reported(address: str, vault: Path) -> None:
+    response = daemon.request(
+        address, {"command": "convert", "path": str(vault / "Missing.md")}
+    )
+
+    assert not response["ok"]
+    assert "Missing.md" in response["error"]
+
+
+def test_unknown_command(address: str, vault: Path) -> None:
+    response = daemon.request(
+        address, {"command": "frobnicate", "path": str(vault / "Note.md")}
+    )
+
+    assert response == {"ok": False, "error": "Unknown command `frobnicate`"}
+
+
+def test_refuses_to_replace_running_daemon(address: str) -> None:
+    with pytest.raises(daemon.DaemonError):
+        daemon.make_server(address, obsidian_to_typst.handle_request)
+
+
+def test_socket_is_private(address: str) -> None:
+    assert stat.S_IMODE(Path(address).stat().st_mode) == 0o600  # noqa: PLR2004
+
+
+def test_default_address_is_per_user(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.delenv("OBSIDIAN_TO_TYPST_DAEMON", raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr("tempfile.tempdir", str(tmp_path))
+
+    address = daemon.default_address()
+    server = daemon.make_server(address, obsidian_to_typst.handle_request)
+    server.server_close()
+
+    socket_dir = Path(address).parent
+    assert socket_dir.parent == tmp_path
+    assert str(os.getuid()) in socket_dir.name
+    assert stat.S_IMODE(socket_dir.stat().st_mode) == 0o700  # noqa: PLR2004
+
+
+def test_refuses_to_listen_beyond_this_machine() -> None:
+    with pytest.raises(daemon.DaemonError, match="loopback"):
+        daemon.make_server("0.0.0.0:0", obsidian_to_typst.handle_request)
+
+
+def test_listens_on_loopback_tcp() -> None:
+    server = daemon.make_server("127.0.0.1:0", obsidian_to_typst.handle_request)
+    server.server_close()
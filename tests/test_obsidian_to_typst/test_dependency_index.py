@@ -0,0 +1,156 @@
+import multiprocessing
+import shutil
+import subprocess
+from pathlib import Path
+
+import pypdf
+import pytest
+from click.testing import CliRunner
+
+from obsidian_to_typst import dependency_index, obsidian_to_typst
+
+
+@pytest.fixture
+def vault(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    (tmp_path / ".obsidian").mkdir()
+    (tmp_path / "notes").mkdir()
+    (tmp_path / "Report.md").write_text(
+        "# Report\n\n![[Section]]\n\nSee [[Glossary]].\n", encoding="UTF-8"
+    )
+    (tmp_path / "notes/Section.md").write_text(
+        "## Section\n\n![[chart.png]]\n", encoding="UTF-8"
+    )
+    (tmp_path / "notes/Glossary.md").write_text(
+        "## Glossary\n", encoding="UTF-8"
+    )
+    (tmp_path / "notes/chart.png").touch()
+    (tmp_path / "Other.md").write_text(
+        "# Other\n\n![[datasheet.pdf]]\n", encoding="UTF-8"
+    )
+    writer = pypdf.PdfWriter()
+    writer.add_blank_page(width=72, height=72)
+    with (tmp_path / "datasheet.pdf").open("wb") as f:
+        writer.write(f)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def stage_all(vault: Path) -> None:
+    for name in ["Report.md", "Other.md"]:
+        obsidian_to_typst.stage_document(vault / name, None)
+
+
+def test_stage_document_records_dependencies(vault: Path) -> None:
+    stage_all(vault)
+
+    assert dependency_index.load(vault) == {
+        "/Report.md": [
+            "/notes/Glossary.md",
+            "/notes/Section.md",
+            "/notes/chart.png",
+        ],
+        "/Other.md": ["/datasheet.pdf"],
+    }
+
+
+@pytest.mark.parametrize(
+    ("changed", "expected"),
+    [
+        ("notes/chart.png", ["Report.md"]),
+        ("notes/Glossary.md", ["Report.md"]),
+        ("datasheet.pdf", ["Other.md"]),
+        ("Other.md", ["Other.md"]),
+        ("notes/Section.md\ndatasheet.pdf", ["Other.md", "Report.md"]),
+        ("Unrelated.md", []),
+    ],
+)
+def test_affected_documents(
+    vault: Path, changed: str, expected: list[str]
+) -> None:
+    stage_all(vault)
+
+    changed_paths = dependency_index.parse_changed_files(changed, vault)
+
+    assert dependency_index.affected_documents(vault, changed_paths) == [
+        vault / name for name in expected
+    ]
+
+
+def test_deleted_documents_are_not_affected(vault: Path) -> None:
+    stage_all(vault)
+    (vault / "Other.md").unlink()
+
+    changed_paths = dependency_index.parse_changed_files(
+        "D\tOther.md\nM\tdatasheet.pdf\n", vault
+    )
+
+    assert dependency_index.affected_documents(vault, changed_paths) == []
+
+
+def record_many(vault: Path, worker: int) -> None:
+    for i in range(20):
+        dependency_index.record(vault, vault / f"{worker}-{i}.md", [])
+
+
+def test_concurrent_processes_keep_each_others_documents(vault: Path) -> None:
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=record_many, args=(vault, worker))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [p.exitcode for p in processes] == [0, 0, 0, 0]
+    assert len(dependency_index.load(vault)) == 80  # noqa: PLR2004
+
+
+def test_restaging_replaces_dependencies(vault: Path) -> None:
+    stage_all(vault)
+    (vault / "Other.md").write_text("# Other\n", encoding="UTF-8")
+
+    obsidian_to_typst.stage_document(vault / "Other.md", None)
+
+    assert dependency_index.load(vault)["/Other.md"] == []
+
+
+def test_missing_index_affects_nothing(vault: Path) -> None:
+    assert dependency_index.affected_documents(vault, [vault / "a.md"]) == []
+
+
+def test_changed_from_dry_run(vault: Path) -> None:
+    stage_all(vault)
+    diff = (
+        "diff --git a/notes/chart.png b/notes/chart.png\n"
+        "--- a/notes/chart.png\n"
+        "+++ b/notes/chart.png\n"
+    )
+
+    result = CliRunner().invoke(
+        obsidian_to_typst.main,
+        ["--changed-from", "-", "--dry-run"],
+        input=diff,
+    )
+
+    assert result.exit_code == 0, result.output
+    assert result.stdout == f"{vault / 'Report.md'}\n"
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+def test_changed_from_resolves_git_paths_from_the_top(
+    vault: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stage_all(vault)
+    subprocess.run(["git", "init", "-q"], cwd=vault, check=True)  # noqa: S607
+    monkeypatch.chdir(vault / "notes")
+
+    result = CliRunner().invoke(
+        obsidian_to_typst.main,
+        ["--changed-from", "-", "--dry-run"],
+        input="notes/chart.png\n",
+    )
+
+    assert result.exit_code == 0, result.output
+    assert result.stdout == f"{vault / 'Report.md'}\n"
@@ -0,0 +1,60 @@
+import time
+from pathlib import Path
+
+import pytest
+
+from obsidian_to_typst import limits, obsidian_path, obsidian_to_typst
+
+
+def test_call_limited_returns_the_result() -> None:
+    budget = limits.Limits(timeout=30)
+
+    assert limits.call_limited(pow, (2, 10), budget, "power") == 1024  # noqa: PLR2004
+
+
+def test_call_limited_raises_the_functions_errors() -> None:
+    with pytest.raises(ValueError, match="invalid literal"):
+        limits.call_limited(int, ("x",), limits.Limits(timeout=30), "int")
+
+
+def test_call_limited_stops_after_the_timeout() -> None:
+    start = time.monotonic()
+
+    with pytest.raises(limits.LimitExceeded, match="sleep took longer"):
+        limits.call_limited(
+            time.sleep, (30,), limits.Limits(timeout=0.5), "sleep"
+        )
+    assert time.monotonic() - start < 10  # noqa: PLR2004
+
+
+@pytest.mark.skipif(limits.resource is None, reason="POSIX only")
+def test_call_limited_limits_memory() -> None:
+    budget = limits.Limits(timeout=30, memory=512)
+
+    with pytest.raises(limits.LimitExceeded, match="allocating ran out"):
+        limits.call_limited(bytearray, (2**32,), budget, "allocating")
+
+
+def test_limits_are_false_when_unset() -> None:
+    assert not limits.Limits()
+    assert limits.Limits(timeout=1)
+    assert limits.Limits(memory=1)
+
+
+def test_stage_limited_converts_in_a_child_process(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    (tmp_path / ".obsidian").mkdir()
+    monkeypatch.chdir(tmp_path)
+    document = tmp_path / "Widget.md"
+    document.write_text("# Widget\n\nSome text\n", encoding="utf-8")
+    monkeypatch.setattr(obsidian_path, "VAULT_ROOT", None)
+
+    temp_wrapper = obsidian_to_typst.stage_limited(
+        document, None, None, limits.Limits(timeout=30)
+    )
+
+    assert temp_wrapper == tmp_path / "temp" / "Widget.typ"
+    assert "Some text" in temp_wrapper.read_text(encoding="utf-8")
+    # The conversion ran elsewhere, and left this process untouched.
+    assert obsidian_path.VAULT_ROOT is None
@@ -1,13 +1,15 @@
 from pathlib import Path
+from unittest import mock
 
 import pytest
 
-from obsidian_to_typst import obsidian_path
+from obsidian_to_typst import cache_store, obsidian_path
 
 
 @pytest.fixture(autouse=True)
 def setup_teardown() -> None:
     yield
+    cache_store.close()
     obsidian_path.VAULT_ROOT = None
 
 
@@ -32,3 +34,41 @@ def test_root_path_top_level(tmp_path: Path) -> None:
     result = obsidian_path.root_path(file_path)
 
     assert result == "/foo.jpg"
+
+
+def test_find_files_walks_the_vault_once_for_missing_files(
+    tmp_path: Path,
+) -> None:
+    obsidian_path.VAULT_ROOT = tmp_path
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.md").touch()
+    obsidian_path.forget_missing()
+
+    with mock.patch.object(
+        obsidian_path, "index_vault", wraps=obsidian_path.index_vault
+    ) as index_vault:
+        found = obsidian_path.find_files(["a.md", "x.md", "y.md"])
+        again = obsidian_path.find_files(["x.md", "y.md"])
+
+    assert found == {
+        "a.md": tmp_path / "sub" / "a.md",
+        "x.md": None,
+        "y.md": None,
+    }
+    assert again == {"x.md": None, "y.md": None}
+    assert index_vault.call_count == 1
+
+
+def test_find_files_only_caches_new_locations(tmp_path: Path) -> None:
+    obsidian_path.VAULT_ROOT = tmp_path
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.md").touch()
+    obsidian_path.forget_missing()
+
+    with mock.patch.object(cache_store, "put", wraps=cache_store.put) as put:
+        obsidian_path.find_files(["a.md"])
+        obsidian_path.find_files(["a.md"])
+        (tmp_path / "sub" / "a.md").rename(tmp_path / "a.md")
+        obsidian_path.find_files(["a.md"])
+
+    assert [c.args[3] for c in put.call_args_list] == ["sub/a.md", "a.md"]
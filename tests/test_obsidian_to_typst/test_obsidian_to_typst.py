@@ -0,0 +1,172 @@
+import json
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from obsidian_to_typst import limits, obsidian_to_typst
+
+
+@pytest.fixture
+def vault(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    (tmp_path / ".obsidian").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_stdin_to_typst_on_stdout(vault: Path) -> None:
+    result = CliRunner().invoke(
+        obsidian_to_typst.main,
+        ["-", "--stdout", "typst"],
+        input="# My Note\n\nHello, World!\n",
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "#set document(title:[My Note], date:auto)" in result.stdout
+    assert result.stdout.endswith("My Note\n\n\n\nHello, World!\n")
+    assert list(vault.iterdir()) == [vault / ".obsidian"]
+
+
+def test_file_to_typst_on_stdout_writes_nothing(vault: Path) -> None:
+    note = vault / "Note.md"
+    note.write_text("# Note\n", encoding="UTF-8")
+
+    result = CliRunner().invoke(
+        obsidian_to_typst.main, [str(note), "--stdout", "typst"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "title:[Note]" in result.stdout
+    assert sorted(vault.iterdir()) == [vault / ".obsidian", note]
+
+
+def test_render_document_writes_nothing(vault: Path) -> None:
+    rendered = obsidian_to_typst.render_document(
+        vault / "stdin.md", "# Title\n\nText\n", None, None
+    )
+
+    assert rendered.body == "Title\n\n\n\nText\n"
+    assert rendered.typst.endswith(rendered.body)
+    assert "title:[Title]" in rendered.typst
+    assert list(vault.iterdir()) == [vault / ".obsidian"]
+
+
+def test_stage_preview_compiles_only_the_section(vault: Path) -> None:
+    note = vault / "Note.md"
+    note.write_text(
+        "# Note\n\n"
+        "## Design\n\nSee [[#Testing]].\n\n"
+        "### Detail\n\nDetail text.\n\n"
+        "## Testing\n\nTesting text.\n",
+        encoding="UTF-8",
+    )
+
+    temp_wrapper = obsidian_to_typst.stage_preview(note, None, "Design")
+
+    typst = temp_wrapper.read_text(encoding="UTF-8")
+    assert temp_wrapper == vault / "temp/Note.preview.typ"
+    assert "title:[Note]" in typst
+    assert "#heading(level:1)[Design] <heading-design>" in typst
+    assert "Detail text." in typst
+    assert "Testing text." not in typst
+    assert typst.endswith("\n\n.<heading-testing>")
+
+
+def test_preview_unknown_heading(vault: Path) -> None:
+    note = vault / "Note.md"
+    note.write_text("# Note\n\n## Design\n", encoding="UTF-8")
+
+    with pytest.raises(ValueError, match="No heading matches `Missing`"):
+        obsidian_to_typst.stage_preview(note, None, "Missing")
+
+
+def test_export_runs_compile_each_format(vault: Path) -> None:
+    note = vault / "Note.md"
+    note.write_text("# Note\n", encoding="UTF-8")
+    temp_wrapper = obsidian_to_typst.stage_document(note, None)
+    export = obsidian_to_typst.Export(formats=("pdf", "svg"), pages="2")
+
+    runs = obsidian_to_typst.export_runs(note, temp_wrapper, export)
+
+    assert [run.args[2:] for run in runs] == [
+        [str(temp_wrapper), "--root", str(vault), "--pages", "2"],
+        [
+            str(temp_wrapper),
+            str(vault / "output/Note-{p}.svg"),
+            "--root",
+            str(vault),
+            "--pages",
+            "2",
+        ],
+    ]
+    assert (vault / "output").is_dir()
+
+
+def test_export_runs_remove_earlier_pages(vault: Path) -> None:
+    note = vault / "Note.md"
+    note.write_text("# Note\n", encoding="UTF-8")
+    temp_wrapper = obsidian_to_typst.stage_document(note, None)
+    output = vault / "output"
+    output.mkdir()
+    for name in ["Note-1.png", "Note-2.png", "Note-1.svg", "Other-1.png"]:
+        (output / name).touch()
+    export = obsidian_to_typst.Export(formats=("png",))
+
+    obsidian_to_typst.export_runs(note, temp_wrapper, export)
+
+    assert sorted(p.name for p in output.iterdir()) == [
+        "Note-1.svg",
+        "Other-1.png",
+    ]
+
+
+def test_exported_files_lists_pages_in_order(vault: Path) -> None:
+    output = vault / "output"
+    output.mkdir()
+    for name in ["Note-1.png", "Note-10.png", "Note-2.png", "Note-x.png"]:
+        (output / name).touch()
+    (output / "Other-1.png").touch()
+    (output / "Note-1.svg").touch()
+
+    assert obsidian_to_typst.exported_files(vault / "Note.md", "png") == [
+        output / "Note-1.png",
+        output / "Note-2.png",
+        output / "Note-10.png",
+    ]
+    assert obsidian_to_typst.exported_files(vault / "Note.md", "pdf") == [
+        output / "Note.pdf"
+    ]
+
+
+def test_unknown_format(vault: Path) -> None:
+    result = CliRunner().invoke(
+        obsidian_to_typst.main, [str(vault / "Note.md"), "--format", "pdf,doc"]
+    )
+
+    assert result.exit_code == 2, result.output  # noqa: PLR2004
+    assert "Unknown formats `doc`" in result.output
+
+
+def test_run_report_counts_a_limited_conversion(vault: Path) -> None:
+    note = vault / "Note.md"
+    note.write_text("# Note\n\n![[Part]]\n\n![[chart.png]]\n", encoding="UTF-8")
+    (vault / "Part.md").write_text("## Part\n\nText\n", encoding="UTF-8")
+    (vault / "chart.png").touch()
+    report = vault / "report.json"
+    prometheus = vault / "run.prom"
+
+    # Converted in a child process, whose counters are added to this one's.
+    with obsidian_to_typst.run_report(report, prometheus):
+        obsidian_to_typst.stage_limited(
+            note, None, None, limits.Limits(timeout=30)
+        )
+
+    counters = json.loads(report.read_text(encoding="UTF-8"))["counters"]
+    assert counters["embedded_notes"] == 1
+    assert counters["images"] == 1
+    assert counters["markdown_bytes"] == note.stat().st_size
+    assert counters["typst_bytes"] > 0
+    assert counters["conversion_seconds"] > 0
+    assert "obsidian_to_typst_embedded_notes 1\n" in prometheus.read_text(
+        encoding="UTF-8"
+    )
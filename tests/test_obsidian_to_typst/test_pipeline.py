@@ -0,0 +1,227 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from obsidian_to_typst import limits, metrics, pipeline
+
+
+def python_run(tmp_path: Path, script: str) -> pipeline.TypstRun:
+    return pipeline.TypstRun(args=[sys.executable, "-c", script], cwd=tmp_path)
+
+
+def test_converts_next_document_while_compiling(tmp_path: Path) -> None:
+    documents = [tmp_path / "one.md", tmp_path / "two.md"]
+    marker = tmp_path / "one.compiled"
+    seen_marker = {}
+
+    def stage(document: Path) -> pipeline.StagedDocument:
+        seen_marker[document.name] = marker.exists()
+        script = "import time; time.sleep(0.5)"
+        if document.name == "one.md":
+            script += f"; open({str(marker)!r}, 'w').close()"
+        return pipeline.StagedDocument(runs=[python_run(tmp_path, script)])
+
+    failures = asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs=2, fail_fast=False)
+    )
+
+    assert failures == []
+    assert marker.exists()
+    assert seen_marker == {"one.md": False, "two.md": False}
+
+
+def test_stderr_is_prefixed_with_document_name(
+    tmp_path: Path, capfd: pytest.CaptureFixture
+) -> None:
+    def stage(_document: Path) -> pipeline.StagedDocument:
+        script = "import sys; sys.stderr.write('warning: foo\\nhint: bar\\n')"
+        return pipeline.StagedDocument(runs=[python_run(tmp_path, script)])
+
+    asyncio.run(
+        pipeline.run_pipeline(
+            [tmp_path / "Widget.md"], stage, jobs=1, fail_fast=False
+        )
+    )
+
+    assert "[Widget.md] warning: foo\n[Widget.md] hint: bar\n" in (
+        capfd.readouterr().err
+    )
+
+
+def test_failures_do_not_stop_other_documents(tmp_path: Path) -> None:
+    documents = [tmp_path / f"{name}.md" for name in ["a", "bad", "c", "d"]]
+    published = []
+
+    def stage(document: Path) -> pipeline.StagedDocument:
+        if document.stem == "d":
+            msg = "conversion broke"
+            raise ValueError(msg)
+        code = 1 if document.stem == "bad" else 0
+        return pipeline.StagedDocument(
+            runs=[python_run(tmp_path, f"raise SystemExit({code})")],
+            publish=lambda: published.append(document.stem),
+        )
+
+    failures = asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs=2, fail_fast=False)
+    )
+
+    assert sorted(published) == ["a", "c"]
+    assert [(f.document.stem, f.stage) for f in failures] == [
+        ("d", "convert"),
+        ("bad", "typst"),
+    ]
+    assert failures[0].error == "conversion broke"
+
+
+def test_fail_fast_cancels_running_typst(tmp_path: Path) -> None:
+    documents = [tmp_path / "slow.md", tmp_path / "bad.md"]
+
+    def stage(document: Path) -> pipeline.StagedDocument:
+        script = "raise SystemExit(1)"
+        if document.stem == "slow":
+            script = "import time; time.sleep(30)"
+        return pipeline.StagedDocument(runs=[python_run(tmp_path, script)])
+
+    start = time.monotonic()
+    failures = asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs=2, fail_fast=True)
+    )
+
+    assert time.monotonic() - start < 10  # noqa: PLR2004
+    assert [f.document.stem for f in failures] == ["bad"]
+
+
+def test_jobs_limits_concurrent_typst_processes(tmp_path: Path) -> None:
+    documents = [tmp_path / f"{i}.md" for i in range(4)]
+    log = tmp_path / "log.txt"
+
+    def stage(document: Path) -> pipeline.StagedDocument:
+        script = (
+            f"import time; f = open({str(log)!r}, 'a'); "
+            f"f.write('start {document.stem}\\n'); f.flush(); "
+            "time.sleep(0.2); "
+            f"f.write('end {document.stem}\\n')"
+        )
+        return pipeline.StagedDocument(runs=[python_run(tmp_path, script)])
+
+    asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs=1, fail_fast=False)
+    )
+
+    events = log.read_text().split()
+    assert events[0::4] == ["start"] * 4
+    assert events[2::4] == ["end"] * 4
+    assert events[1::4] == events[3::4]
+
+
+def test_runs_of_a_document_share_the_job_slots(tmp_path: Path) -> None:
+    log = tmp_path / "log.txt"
+
+    def stage(_document: Path) -> pipeline.StagedDocument:
+        runs = [
+            python_run(
+                tmp_path,
+                f"import time; f = open({str(log)!r}, 'a'); "
+                f"f.write('start {name}\\n'); f.flush(); "
+                "time.sleep(0.2); "
+                f"f.write('end {name}\\n')",
+            )
+            for name in ["pdf", "png"]
+        ]
+        return pipeline.StagedDocument(runs=runs)
+
+    asyncio.run(
+        pipeline.run_pipeline(
+            [tmp_path / "Widget.md"], stage, jobs=1, fail_fast=False
+        )
+    )
+
+    events = log.read_text().split()
+    assert events[0::4] == ["start"] * 2
+    assert events[2::4] == ["end"] * 2
+
+
+def test_failed_run_cancels_the_documents_other_runs(tmp_path: Path) -> None:
+    def stage(_document: Path) -> pipeline.StagedDocument:
+        runs = [
+            python_run(tmp_path, "import time; time.sleep(30)"),
+            python_run(tmp_path, "raise SystemExit(3)"),
+        ]
+        return pipeline.StagedDocument(runs=runs)
+
+    start = time.monotonic()
+    failures = asyncio.run(
+        pipeline.run_pipeline(
+            [tmp_path / "Widget.md"], stage, jobs=2, fail_fast=False
+        )
+    )
+
+    assert time.monotonic() - start < 10  # noqa: PLR2004
+    assert [f.stage for f in failures] == ["typst"]
+    assert "exit status 3" in failures[0].error
+
+
+def test_typst_runs_are_stopped_after_their_timeout(tmp_path: Path) -> None:
+    documents = [tmp_path / "slow.md", tmp_path / "fast.md"]
+    published = []
+
+    def stage(document: Path) -> pipeline.StagedDocument:
+        run = python_run(tmp_path, "pass")
+        if document.stem == "slow":
+            run = python_run(tmp_path, "import time; time.sleep(30)")
+            run.budget = limits.Limits(timeout=0.5)
+        return pipeline.StagedDocument(
+            runs=[run], publish=lambda: published.append(document.stem)
+        )
+
+    start = time.monotonic()
+    failures = asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs=2, fail_fast=False)
+    )
+
+    assert time.monotonic() - start < 10  # noqa: PLR2004
+    assert published == ["fast"]
+    assert [(f.document.stem, f.stage) for f in failures] == [("slow", "typst")]
+    assert failures[0].error == "typst took longer than 0.5 s"
+
+
+@pytest.mark.skipif(
+    not hasattr(limits.resource, "prlimit"), reason="needs prlimit"
+)
+def test_typst_runs_have_their_memory_limited(tmp_path: Path) -> None:
+    # The limit is applied once the child starts, so check it after a pause.
+    script = (
+        "import resource, time; time.sleep(0.5); "
+        "soft, _hard = resource.getrlimit(resource.RLIMIT_AS); "
+        "raise SystemExit(0 if soft == 512 * 2**20 else 5)"
+    )
+    run = python_run(tmp_path, script)
+    run.budget = limits.Limits(memory=512)
+
+    asyncio.run(pipeline.run_typst("limited", run))
+
+
+def test_documents_and_typst_runs_are_counted(tmp_path: Path) -> None:
+    documents = [tmp_path / "good.md", tmp_path / "bad.md"]
+
+    def stage(document: Path) -> pipeline.StagedDocument:
+        code = 1 if document.stem == "bad" else 0
+        return pipeline.StagedDocument(
+            runs=[python_run(tmp_path, f"raise SystemExit({code})")] * 2
+        )
+
+    metrics.reset()
+    asyncio.run(
+        pipeline.run_pipeline(documents, stage, jobs=1, fail_fast=False)
+    )
+
+    counters = metrics.snapshot()
+    assert counters["documents"] == 2  # noqa: PLR2004
+    assert counters["documents_failed"] == 1
+    assert counters["typst_runs"] >= 3  # noqa: PLR2004
+    assert counters["typst_failures"] == 1
+    assert counters["typst_seconds"] > 0
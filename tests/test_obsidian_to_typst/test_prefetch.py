@@ -0,0 +1,122 @@
+from pathlib import Path
+
+import pypdf
+import pytest
+
+from obsidian_to_typst import (
+    cache_store,
+    obsidian_path,
+    prefetch,
+    process_markdown,
+)
+
+
+@pytest.fixture
+def vault(tmp_path: Path) -> Path:
+    (tmp_path / ".obsidian").mkdir()
+    obsidian_path.VAULT_ROOT = tmp_path
+    obsidian_path.forget_missing()
+    process_markdown.OPTIONS = process_markdown.Options()
+    process_markdown.init_state(tmp_path / "temp", tmp_path / "Root.md")
+    yield tmp_path
+    cache_store.close()
+    process_markdown.STATE = process_markdown.State.new()
+    process_markdown.OPTIONS = process_markdown.Options()
+    obsidian_path.VAULT_ROOT = None
+
+
+def write(path: Path, text: str) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="UTF-8")
+    return path
+
+
+def make_pdf(path: Path, page_count: int) -> Path:
+    writer = pypdf.PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(width=72, height=72)
+    with path.open("wb") as f:
+        writer.write(f)
+    return path
+
+
+def test_prefetches_nested_embeds_links_and_pdfs(vault: Path) -> None:
+    a = write(vault / "notes" / "A.md", "## A\n\n![[B]]\n")
+    b = write(vault / "B.md", "## B\n\nSee [[Glossary]].\n")
+    glossary = write(vault / "Glossary.md", "# Glossary\n")
+    pdf = make_pdf(vault / "report.pdf", 3)
+
+    prefetched = prefetch.prefetch("![[A]]\n\n![[report.pdf]]\n")
+
+    assert prefetched.paths == {
+        "A.md": a,
+        "B.md": b,
+        "Glossary.md": glossary,
+        "report.pdf": pdf,
+    }
+    assert prefetched.texts == {
+        a: "## A\n\n![[B]]\n",
+        b: "## B\n\nSee [[Glossary]].\n",
+    }
+    assert prefetched.page_counts == {pdf: 3}
+
+
+def test_prefetch_splits_pdfs_when_embedding_split_pages(vault: Path) -> None:
+    pdf = make_pdf(vault / "report.pdf", 2)
+    process_markdown.OPTIONS = process_markdown.Options(pdf_embed="split")
+
+    prefetched = prefetch.prefetch("![[report.pdf]]\n")
+
+    pages_dir, page_count = prefetched.pdf_splits[pdf]
+    assert page_count == 2  # noqa: PLR2004
+    assert sorted(p.name for p in pages_dir.iterdir()) == ["1.pdf", "2.pdf"]
+
+
+def test_prefetch_leaves_out_what_it_cannot_read(vault: Path) -> None:
+    bad = vault / "Bad.md"
+    bad.write_bytes(b"\xff\xfe\x00")
+
+    prefetched = prefetch.prefetch("![[Missing]]\n![[Bad]]\n")
+
+    assert prefetched.paths == {"Bad.md": bad}
+    assert prefetched.texts == {}
+
+
+def test_converter_uses_prefetched_notes(vault: Path) -> None:
+    note = vault / "A.md"
+    process_markdown.STATE.prefetched = process_markdown.Prefetched(
+        paths={"A.md": note}, texts={note: "## Prefetched\n"}
+    )
+
+    result = process_markdown.obsidian_to_typst("![[A]]\n")
+
+    assert "Prefetched" in result
+    assert not note.exists()
+
+
+def test_prefetch_skips_embeds_the_converter_skips(vault: Path) -> None:
+    write(vault / "Draft.md", "## Draft\n")
+    make_pdf(vault / "example.pdf", 1)
+    process_markdown.OPTIONS = process_markdown.Options(pdf_embed="split")
+
+    prefetched = prefetch.prefetch(
+        "---\nsee: ![[Draft]]\n---\n%%\n![[Draft]]\n%%\n"
+        "```md\n![[example.pdf]]\n```\n"
+    )
+
+    assert prefetched == process_markdown.Prefetched()
+    pages_root = (
+        obsidian_path.cache_dir() / process_markdown.PDF_PAGES_FOLDER_NAME
+    )
+    assert not pages_root.exists()
+
+
+def test_prefetch_stops_reading_at_the_embed_size_limit(vault: Path) -> None:
+    a = write(vault / "A.md", "## A\n\n![[B]]\n")
+    write(vault / "B.md", "## B\n\n![[C]]\n")
+    process_markdown.OPTIONS = process_markdown.Options(max_embed_size=5)
+
+    prefetched = prefetch.prefetch("![[A]]\n")
+
+    assert list(prefetched.texts) == [a]
+    assert "C.md" not in prefetched.paths
@@ -7,7 +7,7 @@
 import pypdf
 import pytest
 
-from obsidian_to_typst import obsidian_path, process_markdown
+from obsidian_to_typst import cache_store, obsidian_path, process_markdown
 
 
 def make_pdf(path: Path, page_count: int) -> None:
@@ -23,15 +23,19 @@ def file_line() -> str:
 
 
 @pytest.fixture(autouse=True)
-def setup_teardown() -> None:
+def setup_teardown(tmp_path: Path) -> None:
     process_markdown.STATE = process_markdown.State.new()
+    process_markdown.OPTIONS = process_markdown.Options()
     test_file = Path.cwd() / "temp/test_file.md"
     process_markdown.STATE.file.append(test_file)
     temp_dir = test_file.parent / "temp"
     process_markdown.STATE.temp_dir = temp_dir
-    obsidian_path.VAULT_ROOT = Path.cwd()
+    obsidian_path.VAULT_ROOT = tmp_path
+    process_markdown.referenced_docs.clear()
+    process_markdown.docs_embedded.clear()
     yield
     process_markdown.STATE = process_markdown.State.new()
+    process_markdown.OPTIONS = process_markdown.Options()
     obsidian_path.VAULT_ROOT = None
 
 
@@ -60,6 +64,89 @@ def setup_teardown() -> None:
             "width: 80%)\n"
         ),
     ),
+    (
+        f"{file_line()} Code block",
+        ("```c\nint x;\n# not a heading\n\n```\nafter\n"),
+        (
+            "\n#block(\nfill: luma(230),\ninset: 8pt,\nradius: 2pt,\n"
+            "stroke: black,\n```c\nint x;\n# not a heading\n\n```\n)\n"
+            "after\n"
+        ),
+    ),
+    (
+        f"{file_line()} Empty code block",
+        ("```\n```\n"),
+        (
+            "\n#block(\nfill: luma(230),\ninset: 8pt,\nradius: 2pt,\n"
+            "stroke: black,\n```\n```\n)\n"
+        ),
+    ),
+    (
+        f"{file_line()} Typst block",
+        ("```typst\n#let a = 1\n```\n"),
+        ("#fit([\n#let a = 1\n])\n"),
+    ),
+    (
+        f"{file_line()} Table",
+        ("| Name | Value |\n| --- | --- |\n| *a* | $5 |\n| b |\n"),
+        (
+            "#table(\ncolumns: 2,\ntable.header([Name], [Value]),\n"
+            "[_a_], [\\$5],\n[b], [],\n)\n"
+        ),
+    ),
+    (
+        f"{file_line()} Brackets in table cells",
+        ("| Field | Bits |\n| --- | --- |\n| x] | bits[7:0] |\n"),
+        (
+            "#table(\ncolumns: 2,\ntable.header([Field], [Bits]),\n"
+            "[x\\]], [bits\\[7:0\\]],\n)\n"
+        ),
+    ),
+    (
+        f"{file_line()} Pipe in a table cell's code span",
+        ("| A | B |\n| --- | --- |\n| *i* | `c|d` |\n| e` | f |\n"),
+        (
+            "#table(\ncolumns: 2,\ntable.header([A], [B]),\n"
+            "[_i_], [`c|d`],\n[e\\`], [f],\n)\n"
+        ),
+    ),
+    (
+        f"{file_line()} Aligned table without outer pipes",
+        ("before\na | b | c\n:-- | :-: | --:\n1 | 2 | 3 | 4\nafter\n"),
+        (
+            "before\n#table(\ncolumns: 3,\nalign: (left, center, right,),\n"
+            "table.header([a], [b], [c]),\n[1], [2], [3],\n)\nafter\n"
+        ),
+    ),
+    (
+        f"{file_line()} Pipes without a delimiter row",
+        ("a | b\nc | d\n"),
+        ("a | b\nc | d\n"),
+    ),
+    (
+        f"{file_line()} Frontmatter and comments",
+        (
+            "---\ntitle: Note\ntags: [a, b]\n---\n# Note\n"
+            "Shown %%hidden%% text\n%%\n# Hidden\n%%\n<!-- html -->\n"
+        ),
+        ("Note\n\n\nShown  text\n\n\n\n\n"),
+    ),
+    (
+        f"{file_line()} Comment markers in code",
+        ("`%%a%%`\n```\n<!-- b -->\n```\n"),
+        (
+            "`%%a%%`\n\n#block(\nfill: luma(230),\ninset: 8pt,\n"
+            "radius: 2pt,\nstroke: black,\n```\n<!-- b -->\n```\n)\n"
+        ),
+    ),
+    (
+        f"{file_line()} Table in a code block",
+        ("```\n| a |\n| - |\n```\n"),
+        (
+            "\n#block(\nfill: luma(230),\ninset: 8pt,\nradius: 2pt,\n"
+            "stroke: black,\n```\n| a |\n| - |\n```\n)\n"
+        ),
+    ),
 ]
 
 
@@ -224,9 +311,278 @@ def test_include_image_single_page_pdf_has_no_pagebreak(
     assert result == '#image("/single.pdf",width:80%,page:1)'
 
 
+def test_include_image_pdf_loop(tmp_path: Path) -> None:
+    pdf_path = tmp_path / "report.pdf"
+    make_pdf(pdf_path, 600)
+    process_markdown.OPTIONS.pdf_embed = "loop"
+
+    with mock.patch(
+        "obsidian_to_typst.process_markdown.obsidian_path.root_path"
+    ) as p:
+        p.return_value = "/report.pdf"
+        result = process_markdown.include_image(pdf_path, 500, None)
+
+    assert result == (
+        "#for page in range(1, 601) {\n"
+        "if page > 1 { pagebreak() }\n"
+        'image("/report.pdf",width:250pt,page:page)\n'
+        "}"
+    )
+
+
+def test_include_image_pdf_split(tmp_path: Path) -> None:
+    obsidian_path.VAULT_ROOT = tmp_path
+    pdf_path = tmp_path / "report.pdf"
+    make_pdf(pdf_path, 3)
+    process_markdown.OPTIONS.pdf_embed = "split"
+
+    result = process_markdown.include_image(pdf_path, None, None)
+
+    pages_dirs = list((tmp_path / ".obsidian-to-typst/pdf-pages").iterdir())
+    assert len(pages_dirs) == 1
+    pages_dir = pages_dirs[0]
+    assert sorted(p.name for p in pages_dir.iterdir()) == [
+        "1.pdf",
+        "2.pdf",
+        "3.pdf",
+    ]
+    assert process_markdown.pdf_page_count(pages_dir / "2.pdf") == 1
+    assert result == (
+        "#for page in range(1, 4) {\n"
+        "if page > 1 { pagebreak() }\n"
+        f'image("/.obsidian-to-typst/pdf-pages/{pages_dir.name}/" '
+        '+ str(page) + ".pdf",width:80%,)\n'
+        "}"
+    )
+
+    with mock.patch("obsidian_to_typst.process_markdown.pypdf") as p:
+        assert process_markdown.include_image(pdf_path, None, None) == result
+    p.PdfReader.assert_not_called()
+
+
+def test_read_only_runs_loop_instead_of_splitting(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(cache_store, "READ_ONLY", True)
+    pdf_path = tmp_path / "report.pdf"
+    make_pdf(pdf_path, 2)
+    process_markdown.OPTIONS.pdf_embed = "split"
+
+    result = process_markdown.include_image(pdf_path, None, None)
+
+    assert 'image("/report.pdf",width:80%,page:page)' in result
+    assert not (tmp_path / ".obsidian-to-typst").exists()
+
+
+def test_failed_split_leaves_no_scratch_folder(tmp_path: Path) -> None:
+    obsidian_path.VAULT_ROOT = tmp_path
+    pdf_path = tmp_path / "report.pdf"
+    make_pdf(pdf_path, 3)
+
+    with (
+        mock.patch.object(
+            pypdf.PdfWriter, "write", side_effect=OSError("disk full")
+        ),
+        pytest.raises(OSError, match="disk full"),
+    ):
+        process_markdown.split_pdf_pages(pdf_path)
+
+    pages_root = tmp_path / ".obsidian-to-typst/pdf-pages"
+    assert list(pages_root.iterdir()) == []
+
+
 def test_pdf_page_count(tmp_path: Path) -> None:
     pdf_path = tmp_path / "multi.pdf"
     expected_page_count = 5
     make_pdf(pdf_path, expected_page_count)
 
     assert process_markdown.pdf_page_count(pdf_path) == expected_page_count
+
+
+def test_unclosed_code_block_is_an_error() -> None:
+    with pytest.raises(AssertionError, match="from line 2"):
+        process_markdown.obsidian_to_typst("text\n```c\nunclosed\n")
+
+
+def test_large_code_block_goes_to_side_file(tmp_path: Path) -> None:
+    process_markdown.STATE.temp_dir = tmp_path
+    process_markdown.OPTIONS.code_side_file_lines = 3
+    input_text = "```c\nint a;\nint b;\nint c;\n```\n```c\nint d;\n```\n"
+
+    result = process_markdown.obsidian_to_typst(input_text)
+
+    side_file = tmp_path / "test_file-code-1.txt"
+    assert side_file.read_text(encoding="UTF-8") == "int a;\nint b;\nint c;"
+    assert (
+        'raw(read("test_file-code-1.txt"), block: true, lang: "c"),' in result
+    )
+    assert "```c\nint d;\n```" in result
+    assert "int a;" not in result
+
+
+def write_notes(tmp_path: Path, notes: dict[str, str]) -> mock.MagicMock:
+    for name, text in notes.items():
+        (tmp_path / name).write_text(text, encoding="UTF-8")
+    return mock.patch(
+        "obsidian_to_typst.process_markdown.obsidian_path.find_file",
+        side_effect=lambda file_name: tmp_path / file_name,
+    )
+
+
+def test_embed_cycle_is_reported_with_full_chain(tmp_path: Path) -> None:
+    notes = {"A.md": "## A\n\n![[B]]\n", "B.md": "## B\n\n![[A]]\n"}
+    process_markdown.STATE.file = [tmp_path / "Root.md"]
+
+    with (
+        write_notes(tmp_path, notes),
+        pytest.raises(process_markdown.EmbedError, match="cycle") as e,
+    ):
+        process_markdown.obsidian_to_typst("# Root\n\n![[A]]\n")
+
+    assert str(e.value) == (
+        "Embedded notes form a cycle: "
+        f"`{tmp_path / 'Root.md'}` -> `{tmp_path / 'A.md'}` -> "
+        f"`{tmp_path / 'B.md'}` -> `{tmp_path / 'A.md'}`"
+    )
+    assert process_markdown.STATE.file == [tmp_path / "Root.md"]
+
+
+def test_self_embed_is_a_cycle(tmp_path: Path) -> None:
+    process_markdown.STATE.file = [tmp_path / "A.md"]
+
+    with (
+        write_notes(tmp_path, {"A.md": "![[A]]\n"}),
+        pytest.raises(process_markdown.EmbedError, match="cycle"),
+    ):
+        process_markdown.obsidian_to_typst("![[A]]\n")
+
+
+def test_embed_depth_limit(tmp_path: Path) -> None:
+    notes = {f"N{i}.md": f"## N{i}\n\n![[N{i + 1}]]\n" for i in range(5)}
+    notes["N5.md"] = "## N5\n"
+    process_markdown.OPTIONS.max_embed_depth = 4
+
+    with (
+        write_notes(tmp_path, notes),
+        pytest.raises(process_markdown.EmbedError, match="more than 4 deep"),
+    ):
+        process_markdown.obsidian_to_typst("![[N0]]\n")
+
+    process_markdown.OPTIONS.max_embed_depth = 6
+    with write_notes(tmp_path, notes):
+        result = process_markdown.obsidian_to_typst("![[N0]]\n")
+    assert "N5" in result
+
+
+def test_embed_size_limit(tmp_path: Path) -> None:
+    notes = {"A.md": "a" * 60 + "\n", "B.md": "b" * 60 + "\n"}
+    process_markdown.OPTIONS.max_embed_size = 100
+
+    with (
+        write_notes(tmp_path, notes),
+        pytest.raises(process_markdown.EmbedError, match="limit of 100"),
+    ):
+        process_markdown.obsidian_to_typst("![[A]]\n![[B]]\n")
+
+
+def test_deep_embed_chain_does_not_recurse(tmp_path: Path) -> None:
+    depth = 1200
+    notes = {f"N{i}.md": f"![[N{i + 1}]]\n" for i in range(depth)}
+    notes[f"N{depth}.md"] = "bottom\n"
+    process_markdown.OPTIONS.max_embed_depth = depth + 1
+
+    with write_notes(tmp_path, notes):
+        result = process_markdown.obsidian_to_typst("![[N0]]\n")
+
+    assert "bottom" in result
+    assert result.count("<file_n") == depth + 1
+
+
+def test_same_note_embedded_twice_is_not_a_cycle(tmp_path: Path) -> None:
+    with write_notes(tmp_path, {"A.md": "text\n"}):
+        result = process_markdown.obsidian_to_typst("![[A]]\n![[A]]\n")
+
+    assert result.count("text") == 2  # noqa: PLR2004
+
+
+def test_unclosed_code_block_line_counts_frontmatter() -> None:
+    text = "---\na: 1\n---\ntext\n```c\ncode\n"
+
+    with pytest.raises(AssertionError, match="closing code block from line 5"):
+        process_markdown.obsidian_to_typst(text)
+
+
+def test_embedded_note_frontmatter_is_dropped(tmp_path: Path) -> None:
+    obsidian_path.VAULT_ROOT = tmp_path
+    (tmp_path / "Part.md").write_text(
+        "---\naliases: [p]\n---\n## Part\n", encoding="UTF-8"
+    )
+
+    result = process_markdown.obsidian_to_typst("# Doc\n![[Part]]\n")
+
+    assert "aliases" not in result
+    assert "#heading(level:1)[Part] <file_part_md>" in result
+
+
+def test_links_are_resolved_together_once_converted(tmp_path: Path) -> None:
+    (tmp_path / "Glossary.md").touch()
+    process_markdown.STATE.file = [tmp_path / "Root.md"]
+    obsidian_path.VAULT_ROOT = tmp_path
+    text = "[[Glossary]], [[Missing]] and [[Missing|again]]\n"
+
+    with (
+        mock.patch.object(
+            obsidian_path,
+            "find_files",
+            wraps=obsidian_path.find_files,
+        ) as find_files,
+        pytest.raises(FileNotFoundError) as e,
+    ):
+        process_markdown.obsidian_to_typst(text)
+
+    find_files.assert_called_once()
+    assert str(e.value) == (
+        f"Unable to locate `Missing.md`, linked from `{tmp_path / 'Root.md'}` "
+        f"under `{tmp_path}`"
+    )
+    assert process_markdown.STATE.dependencies == {tmp_path / "Glossary.md"}
+
+
+def test_duplicate_headings_get_unique_labels(tmp_path: Path) -> None:
+    notes = {"Part.md": "## Part\n\n## Design\n\nSee [[#Design]].\n"}
+    text = (
+        "## Design\n\nSee [[#Design]] and [[#Later]].\n\n"
+        "```md\n## Design\n```\n\n![[Part]]\n\n## Design\n\n## Later\n"
+    )
+    process_markdown.STATE.file = [tmp_path / "Root.md"]
+
+    with write_notes(tmp_path, notes):
+        result = process_markdown.obsidian_to_typst(text)
+
+    labels = re.findall(r"#heading\(level:\d\)\[(.*?)\] <(.*?)>", result)
+    assert labels == [
+        ("Design", "heading-design"),
+        ("Part", "file_part_md"),
+        ("Design", "heading-design-2"),
+        ("Design", "heading-design-1"),
+        ("Later", "heading-later"),
+    ]
+    links = re.findall(r"#link\(<(.*?)>\)", result)
+    assert links == ["heading-design", "heading-later", "heading-design-2"]
+
+
+def test_note_embedded_twice_gets_unique_labels(tmp_path: Path) -> None:
+    notes = {"Part.md": "## Part\n", "Bare.md": "No heading\n"}
+    text = "See [[Part]].\n\n![[Part]]\n\n![[Bare]]\n\n![[Part]]\n\n![[Bare]]\n"
+    process_markdown.STATE.file = [tmp_path / "Root.md"]
+
+    with write_notes(tmp_path, notes):
+        result = process_markdown.obsidian_to_typst(text)
+
+    assert re.findall(r"<(file_.*?)>", result) == [
+        "file_part_md",
+        "file_part_md",
+        "file_bare_md",
+        "file_part_md-1",
+        "file_bare_md-1",
+    ]
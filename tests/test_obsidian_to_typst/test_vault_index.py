@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import pytest
+
+from obsidian_to_typst import cache_store, obsidian_path
+from obsidian_to_typst.vault_index import VaultIndex
+
+
+@pytest.fixture
+def vault(tmp_path: Path) -> Path:
+    (tmp_path / "notes/deep").mkdir(parents=True)
+    (tmp_path / "notes/deep/Note.md").touch()
+    (tmp_path / "Übersicht.md").touch()
+    (tmp_path / obsidian_path.CACHE_FOLDER_NAME).mkdir()
+    (tmp_path / obsidian_path.CACHE_FOLDER_NAME / "Cached.md").touch()
+    obsidian_path.VAULT_ROOT = tmp_path
+    yield tmp_path
+    obsidian_path.VAULT_ROOT = None
+    obsidian_path._INDEXES.clear()  # noqa: SLF001
+    cache_store.close()
+
+
+def test_build_skips_dirs(vault: Path) -> None:
+    index = VaultIndex.build(vault, [obsidian_path.CACHE_FOLDER_NAME])
+
+    assert index.find("Note.md") == vault / "notes/deep/Note.md"
+    assert index.find("Übersicht.md") == vault / "Übersicht.md"
+    assert index.find("Cached.md") is None
+
+
+def test_find_file_sees_added_files(vault: Path) -> None:
+    obsidian_path.find_file("Note.md")
+    (vault / "notes/New.md").touch()
+
+    assert obsidian_path.find_file("New.md") == vault / "notes/New.md"
+
+
+def test_find_file_follows_moved_files(vault: Path) -> None:
+    obsidian_path.find_file("Note.md")
+    (vault / "notes/deep/Note.md").rename(vault / "notes/Note.md")
+
+    assert obsidian_path.find_file("Note.md") == vault / "notes/Note.md"
+
+
+@pytest.mark.usefixtures("vault")
+def test_find_file_missing() -> None:
+    with pytest.raises(FileNotFoundError, match=r"Unable to locate `a\.md`"):
+        obsidian_path.find_file("a.md")
+
+
+def test_small_per_file_overhead() -> None:
+    file_count = 20_000
+    walk = [
+        (f"/v/dir{d}", [], [f"Note number {d}-{f}.md" for f in range(100)])
+        for d in range(file_count // 100)
+    ]
+
+    index = VaultIndex.from_walk(Path("/v"), walk)
+
+    assert len(index) == file_count
+    assert index.find("Note number 7-42.md") == Path(
+        "/v/dir7/Note number 7-42.md"
+    )
+    assert index.nbytes() / file_count < 100  # noqa: PLR2004